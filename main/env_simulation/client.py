@@ -1,88 +1,186 @@
 import socket
+import selectors
 import sys
-import errno
-import pickle
 import time
 import matplotlib.pyplot as plt
+from protocol import HEADER, HEADER_LENGTH, ProtocolError, frame, decode_command, is_newer, \
+    encode_datagram, decode_datagram
 
 
 # Default configuration
-HEADER_LENGTH = 10
 IP = '127.0.0.1'
 PORT = 1234
+UDP_PORT = 1235     # where the board can send datagrams directly, without the relay
+UDP_REGISTRATION_INTERVAL = 2   # seconds, has to be shorter than the relay's UDP_PEER_TIMEOUT
+UDP_RECV_SIZE = 2048
+RECEIVE_TIMEOUT = 0.5   # seconds, how often the receiving thread checks quit_event
+RECEIVE_BUFFER_SIZE = 2 * (2 * HEADER_LENGTH + 65535)  # fits the longest message with room to spare
+SEQ_RESET_AFTER = 1.5  # seconds without commands after which any sequence number is taken - the sender may have restarted
 
 
-def connect_to_server(client_name: str):
+def handshake_name(client_name: str, subscriptions=(), session=''):
+    """
+    Adds handshake options to the client's name.
+
+    :param client_name: string
+    :param subscriptions: names (or topics) of the clients whose messages the server should forward to this one
+    :param session: id of the game session, clients of different sessions never hear each other
+    :return: string, e.g. 'EnvSimulator;sub=RoboPies;session=room1'
+    """
+    if subscriptions:
+        client_name += ';sub=' + ','.join(subscriptions)
+    if session:
+        client_name += f';session={session}'
+    return client_name
+
+
+def connect_to_server(client_name: str, subscriptions=(), session=''):
     """
     Connects to the local server.
 
     :param client_name: string
+    :param subscriptions: names (or topics) of the clients whose messages the server should forward to this one
+    :param session: id of the game session
     :return: client's socket
     """
-    client_name = client_name.encode('utf-8')
-    client_name_header = f'{len(client_name):<{HEADER_LENGTH}}'.encode('utf-8')
+    client_name = handshake_name(client_name, subscriptions, session)
 
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     client_socket.connect((IP, PORT))
+    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     client_socket.setblocking(False)
 
-    client_socket.send(client_name_header + client_name)    # Send id to the server
+    client_socket.send(frame(client_name.encode('utf-8')))    # Send id to the server
 
     return client_socket
 
 
 def send_string_message(client_socket, message: str):
-    message = message.encode('utf-8')
-    message_header = f'{len(message):<{HEADER_LENGTH}}'.encode('utf-8')
-    client_socket.send(message_header + message)
+    client_socket.send(frame(message.encode('utf-8')))
+
+
+def send_message(client_socket, message: bytes):
+    client_socket.send(frame(message))
+
 
+class StreamReassembler:
+    """
+    Turns bytes read from the relay into complete messages. Data is received straight into a preallocated buffer;
+    when the write position reaches its end, the unfinished message is moved to the front and the buffer is
+    reused from the start, so short reads and several messages coalesced in one read are both handled without
+    allocating per read.
+    """
+    def __init__(self, capacity=RECEIVE_BUFFER_SIZE):
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # first byte of the oldest incomplete message
+        self.end = 0    # end of received data
+
+    def recv_from(self, client_socket):
+        """
+        Reads whatever the socket has into the buffer.
+
+        :param client_socket: non-blocking socket
+        :return: number of bytes read, 0 means that the connection was closed
+        """
+        if self.end == len(self.buffer):
+            pending = self.end - self.start
+            self.buffer[:pending] = self.view[self.start:self.end]
+            self.start, self.end = 0, pending
+        received = client_socket.recv_into(self.view[self.end:])
+        self.end += received
+        return received
+
+    def messages(self):
+        """
+        Yields complete messages, leaving the incomplete tail in the buffer.
+
+        :return: generator of (username, message bytes)
+        """
+        while self.end - self.start >= 2 * HEADER_LENGTH:
+            username_length = HEADER.unpack_from(self.buffer, self.start)[0]
+            message_start = self.start + HEADER_LENGTH + username_length
+            if self.end < message_start + HEADER_LENGTH:
+                break
+            message_length = HEADER.unpack_from(self.buffer, message_start)[0]
+            message_end = message_start + HEADER_LENGTH + message_length
+            if self.end < message_end:
+                break
+
+            username = self.buffer[self.start + HEADER_LENGTH:message_start].decode('utf-8')
+            message = bytes(self.view[message_start + HEADER_LENGTH:message_end])
+            self.start = message_end
+            yield username, message
+
+        if self.start == self.end:
+            self.start = self.end = 0
+
+
+def receive_messages(client_socket, quit_event=None):
+    """
+    Waits for messages forwarded by the relay. Blocks in a selector instead of spinning on the non-blocking socket
+    and checks quit_event every RECEIVE_TIMEOUT seconds, also when nothing arrives.
 
-def send_object_message(client_socket, message: object):
-    message = pickle.dumps(message)
-    message_header = bytes(f'{len(message):<{HEADER_LENGTH}}', 'utf-8')
-    client_socket.send(message_header + message)
+    :param client_socket: socket created by connect_to_server
+    :param quit_event: threading.Event that stops the loop or None
+    :return: generator of (username, message bytes)
+    """
+    reassembler = StreamReassembler()
+    selector = selectors.DefaultSelector()
+    selector.register(client_socket, selectors.EVENT_READ)
+
+    try:
+        while quit_event is None or not quit_event.is_set():
+            if not selector.select(RECEIVE_TIMEOUT):
+                continue
+            try:
+                received = reassembler.recv_from(client_socket)
+            except BlockingIOError:
+                continue
+            except OSError as e:
+                print('Reading error', str(e))
+                return
+            if not received:
+                print('Connection closed by the server')
+                return
+            yield from reassembler.messages()
+    finally:
+        selector.close()
 
 
-def show_lag_sender_server(client_socket, packages_num):
+def show_lag_sender_server(client_socket, packages_num, clock_sync=None):
+    """
+    Prints and plots how old commands are when they arrive. Command timestamps are in the relay's time when
+    the board synchronises its clock, so the receiving time is taken from clock_sync as well - otherwise clock
+    skew between the hosts would be counted as lag.
+
+    :param client_socket: socket created by connect_to_server
+    :param packages_num: number of commands to measure
+    :param clock_sync: started ClockSync or None to compare with the local clock
+    :return: none
+    """
+    now = clock_sync.now if clock_sync is not None else time.time_ns
     x_vals = []
     y_vals = []
     index = 0
 
-    while True:
+    for username, message in receive_messages(client_socket):
         try:
-            while index != packages_num:
-                # Receive things
-                username_header = client_socket.recv(HEADER_LENGTH)
-                if not len(username_header):
-                    print('Connection closed by the server')
-                    sys.exit()
-
-                username_length = int(username_header.decode('utf-8').strip())
-                username = client_socket.recv(username_length).decode('utf-8')
-
-                message_header = client_socket.recv(HEADER_LENGTH)
-                message_length = int(message_header.decode('utf-8').strip())
-                message = client_socket.recv(message_length)
-                message = pickle.loads(message)
-
-                lag_ms = (time.time_ns() - message["time"]) / 1_000_000
-                y_vals.append(lag_ms)
-                index += 1
-                x_vals.append(index)
-                print(f'Lag: {lag_ms} ms')
-
-
-        except IOError as e:
-            if e.errno != errno.EAGAIN and e.errno != errno.EWOULDBLOCK:
-                print('Reading error', str(e))
-                sys.exit()
+            message = decode_command(message)
+        except ProtocolError as e:
+            print('General error', str(e))
             continue
 
-        except Exception as e:
-            print('General error', str(e))
-            sys.exit()
+        lag_ms = (now() - message.time) / 1_000_000
+        y_vals.append(lag_ms)
+        index += 1
+        x_vals.append(index)
+        print(f'Lag: {lag_ms} ms')
+        if index == packages_num:
+            break
+    else:
+        sys.exit()
 
-        break
     plt.hist(y_vals)
     plt.title('Histogram of delays between data sender and receiver')
     plt.xlabel('Delay in ms')
@@ -90,38 +188,105 @@ def show_lag_sender_server(client_socket, packages_num):
     plt.show()
 
 
-def receive_commands_from_server(client_socket, fifo_buffer, quit_event):
-
-    # It will quit if server is down or PyGame window is closed and it receives one last message to end the loop
-
-    while True:
+def receive_commands_from_server(client_socket, fifo_buffer, quit_event, trace=None):
+    """
+    Puts commands received from the server in the buffer. Returns when the server closes the connection
+    or quit_event is set.
+
+    :param client_socket: socket created by connect_to_server
+    :param fifo_buffer: CommandMailbox (or queue) for received commands
+    :param quit_event: threading.Event that stops the loop
+    :param trace: TraceWriter or None
+    :return: none
+    """
+    for username, message in receive_messages(client_socket, quit_event):
         try:
-            while True:
-                # Receive things
-                username_header = client_socket.recv(HEADER_LENGTH)
-                if not len(username_header):
-                    print('Connection closed by the server')
-                    sys.exit()
+            command = decode_command(message)
+        except ProtocolError as e:
+            print(f'Skipping message from {username}: {e}')
+            continue
+        if trace is not None:
+            trace.stamp('game_receive', command.seq)
+        fifo_buffer.put(command)
 
-                username_length = int(username_header.decode('utf-8').strip())
-                username = client_socket.recv(username_length).decode('utf-8')
 
-                message_header = client_socket.recv(HEADER_LENGTH)
-                message_length = int(message_header.decode('utf-8').strip())
-                message = client_socket.recv(message_length)
-                message = pickle.loads(message)
+def open_datagram_socket(port=UDP_PORT):
+    """
+    Creates UDP socket for the latest-wins transport. It receives both datagrams sent straight from the board
+    and the ones forwarded by the relay.
 
-                fifo_buffer.put(message)
+    :param port: local port
+    :return: client's socket
+    """
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp_socket.bind(('', port))
+    udp_socket.setblocking(False)
+    return udp_socket
 
-                if quit_event.isSet():
-                    sys.exit()
 
-        except IOError as e:
-            if e.errno != errno.EAGAIN and e.errno != errno.EWOULDBLOCK:
-                print('Reading error', str(e))
-                sys.exit()
-            continue
+def receive_datagrams(udp_socket, client_name, subscriptions, fifo_buffer, quit_event, session='', trace=None,
+                      reset_after=SEQ_RESET_AFTER):
+    """
+    Receives commands over UDP. Every datagram waiting in the socket is read at once; stale and out of order
+    commands are dropped and the rest go to the mailbox, which keeps only the newest one. The board sends
+    heartbeats, so after reset_after seconds without a command it is gone or restarted - the next command is taken
+    whatever its sequence number. Registration with the relay is repeated every UDP_REGISTRATION_INTERVAL seconds.
 
-        except Exception as e:
-            print('General error', str(e))
-            sys.exit()
\ No newline at end of file
+    :param udp_socket: socket created by open_datagram_socket
+    :param client_name: string
+    :param subscriptions: names of the senders the relay should forward
+    :param fifo_buffer: CommandMailbox for received commands
+    :param quit_event: threading.Event that stops the loop
+    :param session: id of the game session
+    :param trace: TraceWriter or None
+    :param reset_after: seconds of silence after which the sequence numbers start over
+    :return: none
+    """
+    registration = encode_datagram(handshake_name(client_name, subscriptions, session).encode('utf-8'), b'')
+    last_registration = 0
+    last_seq = None
+    last_accepted = 0
+    dropped = 0
+    selector = selectors.DefaultSelector()
+    selector.register(udp_socket, selectors.EVENT_READ)
+
+    try:
+        while not quit_event.is_set():
+            now = time.monotonic()
+            if now - last_registration > UDP_REGISTRATION_INTERVAL:
+                last_registration = now
+                try:
+                    udp_socket.sendto(registration, (IP, PORT))
+                except OSError:
+                    pass    # No relay - the board may still send to us directly
+
+            if not selector.select(RECEIVE_TIMEOUT):
+                continue
+            if time.monotonic() - last_accepted > reset_after:
+                last_seq = None
+            datagrams = []
+            while True:
+                try:
+                    datagrams.append(udp_socket.recv(UDP_RECV_SIZE))
+                except (BlockingIOError, ConnectionRefusedError):
+                    break
+
+            for data in datagrams:
+                try:
+                    _, payload = decode_datagram(data)
+                    command = decode_command(payload)
+                except (ProtocolError, UnicodeDecodeError):
+                    dropped += 1
+                    continue
+                if last_seq is not None and not is_newer(command.seq, last_seq):
+                    dropped += 1
+                    continue
+                last_seq = command.seq
+                last_accepted = time.monotonic()
+                if trace is not None:
+                    trace.stamp('game_receive', command.seq)
+                fifo_buffer.put(command)
+    finally:
+        selector.close()
+        udp_socket.close()
+        print(f'UDP receiver closed, {dropped} datagrams dropped')
@@ -0,0 +1,149 @@
+import select
+import socket
+import threading
+import time
+from collections import deque
+from protocol import ProtocolError, encode_ping, decode_pong, encode_datagram, decode_datagram
+
+
+# Clock synchronisation shared by single_board and env_simulation - keep the copies identical
+SYNC_INTERVAL = 2   # seconds between pings once synchronised
+FAST_PINGS = 8  # pings sent every FAST_INTERVAL after the start, so the first estimate comes quickly
+FAST_INTERVAL = 0.1
+PONG_TIMEOUT = 1    # seconds, a later pong is dropped
+SYNC_WINDOW = 32    # samples kept for the estimate
+MIN_DRIFT_SPAN = 10     # seconds the trusted samples have to span before drift is estimated
+MAX_DRIFT = 500e-6  # 500 ppm, a steeper fitted drift is noise
+RECV_SIZE = 256
+
+
+class ClockSync:
+    """
+    Estimates the offset of the relay's clock from the local one with NTP style ping/pong datagrams. A ping
+    carries its send time t0, the relay stamps its arrival t1 and the reply t2, the pong arrives at t3:
+
+        round trip = (t3 - t0) - (t2 - t1)      offset = ((t1 - t0) + (t2 - t3)) / 2
+
+    The offset is exact when both directions take RTT/2 and wrong by at most RTT/2 otherwise, so only the half of
+    the recent samples with the shortest round trips is trusted. A line fitted through them gives the drift,
+    which keeps the offset right between pings. Until the first pong the offset is 0 - local time is used as is.
+    """
+    def __init__(self, client_name, address, interval=SYNC_INTERVAL, window=SYNC_WINDOW):
+        """
+        :param client_name: string, only names the pings
+        :param address: (ip, port) of the relay
+        :param interval: seconds between pings
+        :param window: number of samples kept
+        """
+        self.client_name = client_name.encode('utf-8')
+        self.address = address
+        self.interval = interval
+        self.samples = deque(maxlen=window)     # (local time of the exchange's midpoint, offset, round trip)
+        self.estimate = (0, 0, 0.0)     # local reference time, offset at it in ns, drift - replaced as a whole
+        self.synced = threading.Event()
+        self.quit_event = threading.Event()
+        self.thread = None
+        self.pings = 0
+        self.lost = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True, name='clock-sync')
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.quit_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=PONG_TIMEOUT + 1)
+
+    def run(self):
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            while not self.quit_event.is_set():
+                self.exchange(udp_socket)
+                self.quit_event.wait(FAST_INTERVAL if self.pings < FAST_PINGS else self.interval)
+        finally:
+            udp_socket.close()
+
+    def exchange(self, udp_socket):
+        """
+        Sends one ping and waits for its pong.
+
+        :param udp_socket: UDP socket of the synchronisation
+        :return: none
+        """
+        self.pings += 1
+        sent_at = time.time_ns()
+        try:
+            udp_socket.sendto(encode_datagram(self.client_name, encode_ping(sent_at)), self.address)
+        except OSError:
+            self.lost += 1
+            return
+
+        deadline = time.monotonic() + PONG_TIMEOUT
+        while (timeout := deadline - time.monotonic()) > 0:
+            if not select.select([udp_socket], [], [], timeout)[0]:
+                break
+            try:
+                data = udp_socket.recv(RECV_SIZE)
+            except OSError:
+                break
+            received_at = time.time_ns()
+            try:
+                t0, t1, t2 = decode_pong(decode_datagram(data)[1])
+            except (ProtocolError, UnicodeDecodeError):
+                continue
+            if t0 == sent_at:   # Not a late pong of an earlier ping
+                self.add_sample(t0, t1, t2, received_at)
+                return
+        self.lost += 1
+
+    def add_sample(self, t0, t1, t2, t3):
+        """
+        :param t0: ping sent, local time.time_ns()
+        :param t1: ping received, relay's time.time_ns()
+        :param t2: pong sent, relay's time.time_ns()
+        :param t3: pong received, local time.time_ns()
+        :return: none
+        """
+        round_trip = (t3 - t0) - (t2 - t1)
+        offset = ((t1 - t0) + (t2 - t3)) // 2
+        self.samples.append(((t0 + t3) // 2, offset, round_trip))
+
+        trusted = sorted(self.samples, key=lambda sample: sample[2])[:max(1, len(self.samples) // 2)]
+        times = [sample[0] for sample in trusted]
+        if max(times) - min(times) < MIN_DRIFT_SPAN * 1e9:
+            best = trusted[0]
+            self.estimate = (best[0], best[1], self.estimate[2])    # Drift known so far still applies
+        else:
+            mean_time = sum(times) / len(times)
+            mean_offset = sum(sample[1] for sample in trusted) / len(trusted)
+            spread = sum((sample_time - mean_time) ** 2 for sample_time in times)
+            drift = sum((sample[0] - mean_time) * (sample[1] - mean_offset) for sample in trusted) / spread
+            self.estimate = (int(mean_time), int(mean_offset), min(max(drift, -MAX_DRIFT), MAX_DRIFT))
+        self.synced.set()
+
+    def offset_at(self, local_ns):
+        """
+        :param local_ns: local time.time_ns()
+        :return: ns to add to it to get the relay's time
+        """
+        reference, offset, drift = self.estimate
+        return offset + int(drift * (local_ns - reference))
+
+    def to_relay_time(self, local_ns):
+        return local_ns + self.offset_at(local_ns)
+
+    def now(self):
+        """
+        :return: relay's time.time_ns() - use instead of time.time_ns() for stamps compared across hosts
+        """
+        return self.to_relay_time(time.time_ns())
+
+    def stats(self):
+        round_trips = [sample[2] for sample in self.samples]
+        return {'offset_ms': round(self.offset_at(time.time_ns()) / 1e6, 3),
+                'drift_ppm': round(self.estimate[2] * 1e6, 2),
+                'min_rtt_ms': round(min(round_trips) / 1e6, 3) if round_trips else None,
+                'pings': self.pings,
+                'lost': self.lost}
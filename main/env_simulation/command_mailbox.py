@@ -0,0 +1,54 @@
+import threading
+from collections import Counter
+
+
+class CommandMailbox:
+    """
+    Hands commands from the receiving thread over to the Player. Instead of queueing every command, pending ones
+    are merged: the newest movement wins and one-off actions ('shoot', 'change') are counted, so input latency
+    stays at most one game frame however fast the board sends.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latest = None
+        self.actions = Counter()
+        self.depth = 0          # commands merged since the last take()
+        self.max_depth = 0
+        self.received = 0
+        self.dropped = 0        # commands superseded before the Player saw them
+
+    def put(self, command):
+        """
+        Merges command with the pending ones. Called from the receiving thread.
+
+        :param command: protocol.Command
+        :return: none
+        """
+        with self.lock:
+            if self.latest is not None:
+                self.dropped += 1
+            self.latest = command
+            if command.action:
+                self.actions[command.action] += 1
+            self.depth += 1
+            self.received += 1
+            if self.depth > self.max_depth:
+                self.max_depth = self.depth
+
+    def take(self):
+        """
+        Empties the mailbox. Called once per game frame.
+
+        :return: newest command and Counter of actions received since the last call, or None, None
+        """
+        with self.lock:
+            if self.latest is None:
+                return None, None
+            command, actions = self.latest, self.actions
+            self.latest = None
+            self.actions = Counter()
+            self.depth = 0
+        return command, actions
+
+    def stats(self):
+        return {'depth': self.depth, 'max_depth': self.max_depth, 'received': self.received, 'dropped': self.dropped}
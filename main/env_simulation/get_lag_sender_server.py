@@ -1,6 +1,12 @@
 import client
+from clock_sync import ClockSync
 
 PACKAGES_NUM = 500
+SYNC_TIMEOUT = 5    # seconds to wait for the first clock estimate
 
-client_socket = client.connect_to_server('LagListener')
-client.show_lag_sender_server(client_socket, PACKAGES_NUM)
+clock_sync = ClockSync('LagListener', (client.IP, client.PORT)).start()
+if not clock_sync.synced.wait(SYNC_TIMEOUT):
+    print('No answer to clock sync pings, lag includes the clock skew between the hosts')
+client_socket = client.connect_to_server('LagListener', subscriptions=['RoboPies'])
+client.show_lag_sender_server(client_socket, PACKAGES_NUM, clock_sync)
+print(f'Clock of the relay: {clock_sync.stats()}')
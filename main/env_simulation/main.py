@@ -1,7 +1,12 @@
 import sys
+import time
 from sprites import *
 from os import path, environ
 from tilemap import *
+from tracing import TraceWriter
+from clock_sync import ClockSync
+from profiler import FrameProfiler
+from client import IP, PORT
 
 
 def collide_hit_rect(one, two):
@@ -54,6 +59,11 @@ class Game:
         pg.key.set_repeat(100, 100)  # Delay and interval in milliseconds
         self.load_data()
         self.targets = []
+        self.clock_sync = ClockSync('EnvSimulator', (IP, PORT)).start() if CLOCK_SYNC else None
+        self.trace = TraceWriter(TRACE_FILE, 'game', self.clock_sync.now if CLOCK_SYNC else time.time_ns) \
+            if TRACE_FILE else None     # Outlives players of restarted games
+        self.profiler = FrameProfiler(PROFILE, PROFILE_FRAMES, 1000 / FPS)
+        self.player = None
 
     def draw_text(self, text, font_name, size, color, x, y, align="nw"):
         """
@@ -177,6 +187,10 @@ class Game:
 
         :return: none
         """
+        # Player of the previous game has to free the command port before the new one binds it
+        if self.player is not None:
+            self.player.stop_command_thread()
+
         # Creating groups for objects - easy updates
         self.all_sprites = pg.sprite.LayeredUpdates()   # just like Group(), but has layer property - draws in order
         self.walls = pg.sprite.Group()
@@ -206,6 +220,7 @@ class Game:
         self.camera = Camera(self.map.width, self.map.height)
 
         self.draw_debug = False
+        self.show_profile = False
         self.paused = False
         self.night = False
 
@@ -223,7 +238,9 @@ class Game:
         pg.mixer.music.play(loops=-1)   # Plays background music
         while self.playing:
             self.dt = self.clock.tick(FPS) / 1000   # How many seconds have passed since the previous frame
+            self.profiler.start_frame(mobs=len(self.mobs), sprites=len(self.all_sprites))   # Waiting in tick() excluded
             self.events()
+            self.profiler.mark('events')
             if not self.paused:
                 self.update()
             self.draw()
@@ -234,7 +251,15 @@ class Game:
 
         :return: none
         """
-        self.player.quit_event.set()    # Helps to close connection with the server
+        self.player.stop_command_thread()   # Closes connection with the server
+        print(f'Command mailbox: {self.player.commands.stats()}')
+        if self.clock_sync is not None:
+            self.clock_sync.stop()
+            print(f'Clock of the relay: {self.clock_sync.stats()}')
+        if self.trace is not None:
+            self.trace.close()
+        if PROFILE_FILE:
+            self.profiler.dump(PROFILE_FILE)
         pg.quit()
         sys.exit()
 
@@ -245,8 +270,9 @@ class Game:
         :return: none
         """
         # Game loop - update
-        self.all_sprites.update()
+        self.profiler.update_sprites(self.all_sprites)
         self.camera.update(self.player)
+        self.profiler.mark('camera')
 
         # Game over?
         if len(self.mobs) == 0:
@@ -280,6 +306,7 @@ class Game:
                 self.effects_sounds["potion"].play()
                 self.player.visible = False
                 self.player.invisibility_timer = pg.time.get_ticks()
+        self.profiler.mark('collide items')
 
         # Mob hits player
         hits = pg.sprite.spritecollide(self.player, self.mobs, False, collide_hit_rect)
@@ -293,6 +320,7 @@ class Game:
             if hits:
                 self.player.hit()
                 self.player.pos += vec(MOB_KNOCKBACK, 0).rotate(-hits[0].rot)
+        self.profiler.mark('collide mobs')
 
         # Bullet hits mob
         hits = pg.sprite.groupcollide(self.mobs, self.bullets, False, True)     # Kill bullet after hit
@@ -301,6 +329,7 @@ class Game:
             for bullet in hits[mob]:
                 mob.health -= bullet.damage
             mob.vel = vec(0, 0)
+        self.profiler.mark('collide bullets')
 
     def render_fog(self):
         """
@@ -321,6 +350,7 @@ class Game:
         """
         pg.display.set_caption(f"{round(self.clock.get_fps(), 2)}")
         self.screen.blit(self.map_image, self.camera.apply_rect(self.map_rect))
+        self.profiler.mark('map')
 
         for sprite in self.all_sprites:
             if isinstance(sprite, Mob):
@@ -329,13 +359,19 @@ class Game:
             if self.draw_debug:
                 if not isinstance(sprite, (MuzzleFlash, BloodSplat)):
                     pg.draw.rect(self.screen, CYAN, self.camera.apply_rect(sprite.hit_rect), 1)
+        self.profiler.mark('sprites')
 
         if self.draw_debug:
             for wall in self.walls:
                 pg.draw.rect(self.screen, CYAN, self.camera.apply_rect(wall.rect), 1)
+            stats = self.player.commands.stats()
+            self.draw_text(f"Commands: {stats['received']} received, {stats['dropped']} merged, "
+                           f"max queue depth {stats['max_depth']}", self.hud_font, 20, CYAN, 10, HEIGHT-10, "sw")
+            self.profiler.mark('debug')
 
         if self.night:
             self.render_fog()
+            self.profiler.mark('fog')
 
         # HUD functions
         draw_player_health(self.screen, 10, 10, self.player.health/PLAYER_HEALTH)
@@ -348,8 +384,14 @@ class Game:
         if self.paused:
             self.screen.blit(self.dim_screen, (0, 0))
             self.draw_text("Paused", self.title_font, 105, RED, WIDTH//2, HEIGHT//2, "center")
+        self.profiler.mark('hud')
+
+        if self.show_profile:
+            self.profiler.draw(self.screen, 10, HEIGHT - 160)    # Above the debug line
+            self.profiler.mark('profiler')
 
         pg.display.flip()
+        self.profiler.mark('flip')
 
     def events(self):
         """
@@ -372,6 +414,10 @@ class Game:
                     self.paused = not self.paused
                 if event.key == pg.K_n:
                     self.night = not self.night
+                if event.key == pg.K_f:
+                    self.show_profile = not self.show_profile
+                if event.key == pg.K_l and PROFILE_FILE:
+                    self.profiler.dump(PROFILE_FILE)
                 if event.key == pg.K_j:
                     # Press 'J' to reconnect to the server
                     if self.player.commands_thread_number == 0:
@@ -0,0 +1,171 @@
+import csv
+import time
+from collections import deque
+import pygame as pg
+
+PALETTE = [(230, 25, 75), (60, 180, 75), (255, 225, 25), (0, 130, 200), (245, 130, 48), (145, 30, 180),
+           (70, 240, 240), (240, 50, 230), (210, 245, 60), (250, 190, 212), (0, 128, 128), (220, 190, 255),
+           (170, 110, 40), (255, 250, 200), (128, 0, 0), (170, 255, 195)]
+GRAPH_SIZE = (300, 120)     # px, one column per frame
+GRAPH_SCALE = 2     # graph height in frame budgets
+LEGEND_INTERVAL = 30    # frames between redraws of the legend
+
+
+class FrameProfiler:
+    """
+    Splits every frame of the game loop into named sections and keeps their times for the last few hundred frames.
+    The loop calls mark(section) after each part of the frame - a section is the time since the previous mark, so
+    marking costs one perf_counter_ns(). Sections come and go (fog only at night, no updates while paused), a frame
+    keeps only those that ran.
+    """
+    def __init__(self, enabled=True, frames=300, budget_ms=1000 / 60):
+        """
+        :param enabled: False makes every method a no-op, sprites are then updated by their group as usual
+        :param frames: size of the ring buffer
+        :param budget_ms: frame time the game aims for, drawn as a line across the graph
+        """
+        self.enabled = enabled
+        self.frames = deque(maxlen=frames)  # (counts, {section: ms}) of finished frames
+        self.sections = []  # in the order first seen, fixes their colors and order in the stack
+        self.counts = {}
+        self.current = {}
+        self.last = 0
+        self.frame_number = 0
+        self.budget_ms = budget_ms
+        self.graph = None
+        self.legend = None
+        self.font = None
+
+    def start_frame(self, **counts):
+        """
+        Finishes the previous frame and starts timing a new one.
+
+        :param counts: values to keep with the frame, e.g. mobs=len(game.mobs)
+        :return: none
+        """
+        if not self.enabled:
+            return
+        if self.current:
+            self.frames.append((self.counts, self.current))
+        self.counts = counts
+        self.current = {}
+        self.frame_number += 1
+        self.last = time.perf_counter_ns()
+
+    def mark(self, section):
+        """
+        Ends a section of the current frame.
+
+        :param section: name, e.g. 'events'
+        :return: none
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter_ns()
+        self.add(section, now - self.last)
+        self.last = now
+
+    def add(self, section, duration):
+        if section not in self.current:
+            if section not in self.sections:
+                self.sections.append(section)
+            self.current[section] = 0
+        self.current[section] += duration / 1e6
+
+    def update_sprites(self, group):
+        """
+        Updates the sprites of the group in its own order, like group.update(), timing them by sprite type.
+
+        :param group: pg.sprite.Group
+        :return: none
+        """
+        if not self.enabled:
+            group.update()
+            return
+        durations = {}
+        for sprite in group.sprites():
+            start = time.perf_counter_ns()
+            sprite.update()
+            kind = type(sprite)
+            durations[kind] = durations.get(kind, 0) + time.perf_counter_ns() - start
+        for kind, duration in durations.items():
+            self.add(f'update {kind.__name__}', duration)
+        self.last = time.perf_counter_ns()
+
+    def draw(self, screen, x, y):
+        """
+        Draws the stacked frame time graph with its legend. The graph is kept between frames and scrolled by one
+        column, so only the newest frame is drawn each time.
+
+        :param screen: surface to draw on
+        :param x: left edge of the graph
+        :param y: top edge of the graph
+        :return: none
+        """
+        if not self.enabled or not self.frames:
+            return
+        width, height = GRAPH_SIZE
+        px_per_ms = height / (GRAPH_SCALE * self.budget_ms)
+        if self.graph is None:
+            self.graph = pg.Surface(GRAPH_SIZE)
+            self.font = pg.font.Font(None, 18)
+
+        self.graph.scroll(-1, 0)
+        pg.draw.line(self.graph, (0, 0, 0), (width - 1, 0), (width - 1, height - 1))
+        _, times = self.frames[-1]
+        bottom = height
+        for index, section in enumerate(self.sections):
+            if section in times:
+                top = bottom - times[section] * px_per_ms
+                pg.draw.line(self.graph, PALETTE[index % len(PALETTE)], (width - 1, bottom - 1), (width - 1, top))
+                bottom = top
+
+        screen.blit(self.graph, (x, y))
+        budget_y = y + height - self.budget_ms * px_per_ms
+        pg.draw.line(screen, (255, 255, 255), (x, budget_y), (x + width - 1, budget_y))
+
+        if self.legend is None or self.frame_number % LEGEND_INTERVAL == 0:
+            self.legend = self.render_legend()
+        screen.blit(self.legend, (x + width + 5, y + height - self.legend.get_height()))   # Grows upwards
+
+    def render_legend(self):
+        means = self.means()
+        lines = [(f'frame {round(sum(means.values()), 2)} ms / {round(self.budget_ms, 1)}', (255, 255, 255))]
+        lines += [(f'{section} {round(means.get(section, 0), 2)}', PALETTE[index % len(PALETTE)])
+                  for index, section in enumerate(self.sections)]
+        line_height = self.font.get_linesize()
+        legend = pg.Surface((max(self.font.size(text)[0] for text, _ in lines), line_height * len(lines)))
+        for number, (text, color) in enumerate(lines):
+            legend.blit(self.font.render(text, True, color), (0, number * line_height))
+        return legend
+
+    def means(self):
+        """
+        :return: {section: mean ms per frame} over the ring buffer
+        """
+        totals = {}
+        for _, times in self.frames:
+            for section, duration in times.items():
+                totals[section] = totals.get(section, 0) + duration
+        return {section: duration / len(self.frames) for section, duration in totals.items()}
+
+    def dump(self, path):
+        """
+        Writes the ring buffer to a CSV file, one row per frame.
+
+        :param path: file to write
+        :return: none
+        """
+        if not self.enabled or not self.frames:
+            return
+        count_names = list(self.frames[-1][0])
+        with open(path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['frame'] + count_names + ['total_ms'] + [f'{section}_ms' for section in self.sections])
+            first = self.frame_number - 1 - len(self.frames)    # The current frame is not finished yet
+            for number, (counts, times) in enumerate(self.frames, first):
+                writer.writerow([number] + [counts.get(name, '') for name in count_names]
+                                + [round(sum(times.values()), 3)]
+                                + [round(times.get(section, 0), 3) for section in self.sections])
+        over_budget = sum(1 for _, times in self.frames if sum(times.values()) > self.budget_ms)
+        print(f'Frame profile written to {path}: {len(self.frames)} frames, {over_budget} over the budget')
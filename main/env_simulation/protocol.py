@@ -0,0 +1,159 @@
+import struct
+import time
+from dataclasses import dataclass
+
+
+# Wire format shared by single_board, server and env_simulation - keep the copies identical
+VERSION = 1
+HEADER = struct.Struct('!H')    # length of the message that follows
+HEADER_LENGTH = HEADER.size
+COMMAND = struct.Struct('!BBBBIq')  # version, kind, move, action, sequence number, timestamp in ns
+SYNC = struct.Struct('!BBqqq')  # version, kind, ping sent, ping received by the relay, pong sent - time.time_ns()
+SEQ_MODULO = 2 ** 32
+
+# Message kinds
+KIND_COMMAND = 0
+KIND_HEARTBEAT = 1  # repeats the current movement, proves that the sender is alive
+KIND_HAND_LOST = 2
+KIND_PING = 3   # clock synchronisation request, answered by the relay and never forwarded
+KIND_PONG = 4
+
+MOVES = ('', 'up-left', 'up', 'up-right', 'left', 'stand', 'right', 'down-left', 'down', 'down-right')
+ACTIONS = ('', 'shoot', 'change')
+MOVE_CODES = {move: code for code, move in enumerate(MOVES)}
+ACTION_CODES = {action: code for code, action in enumerate(ACTIONS)}
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+@dataclass
+class Command:
+    move: str
+    action: str
+    seq: int = 0
+    time: int = 0
+    kind: int = KIND_COMMAND
+
+
+def frame(payload: bytes):
+    """
+    Prepends length header to the payload.
+
+    :param payload: bytes
+    :return: bytes ready to be written to a stream
+    """
+    return HEADER.pack(len(payload)) + payload
+
+
+def encode_command(move: str, action: str, seq: int, timestamp: int = 0, kind: int = KIND_COMMAND):
+    """
+    Packs command into a fixed 16 byte message.
+
+    :param move: one of MOVES
+    :param action: one of ACTIONS
+    :param seq: sequence number, wraps at 2**32
+    :param timestamp: time.time_ns() of the sender or 0
+    :param kind: KIND_* constant
+    :return: bytes
+    """
+    return COMMAND.pack(VERSION, kind, MOVE_CODES[move], ACTION_CODES[action], seq % SEQ_MODULO, timestamp)
+
+
+def decode_command(data):
+    """
+    Unpacks message created by encode_command.
+
+    :param data: bytes-like object
+    :return: Command
+    """
+    if len(data) != COMMAND.size:
+        raise ProtocolError(f'Command has {len(data)} bytes, expected {COMMAND.size}')
+    version, kind, move, action, seq, timestamp = COMMAND.unpack(data)
+    if version != VERSION:
+        raise ProtocolError(f'Unsupported protocol version {version}')
+    try:
+        return Command(MOVES[move], ACTIONS[action], seq, timestamp, kind)
+    except IndexError:
+        raise ProtocolError(f'Unknown move {move} or action {action}') from None
+
+
+def encode_ping(sent_at: int):
+    """
+    :param sent_at: time.time_ns() of the client
+    :return: bytes
+    """
+    return SYNC.pack(VERSION, KIND_PING, sent_at, 0, 0)
+
+
+def is_ping(data):
+    return len(data) == SYNC.size and data[0] == VERSION and data[1] == KIND_PING
+
+
+def encode_pong(ping, received_at: int):
+    """
+    Answers a ping with the relay's time of its receipt and of the reply.
+
+    :param ping: bytes created by encode_ping
+    :param received_at: time.time_ns() of the relay when the ping arrived
+    :return: bytes
+    """
+    return SYNC.pack(VERSION, KIND_PONG, SYNC.unpack(ping)[2], received_at, time.time_ns())
+
+
+def decode_pong(data):
+    """
+    Unpacks message created by encode_pong.
+
+    :param data: bytes-like object
+    :return: ping sent, ping received, pong sent - (t0, t1, t2) of the NTP exchange
+    """
+    if len(data) != SYNC.size:
+        raise ProtocolError(f'Clock sync message has {len(data)} bytes, expected {SYNC.size}')
+    version, kind, sent_at, received_at, replied_at = SYNC.unpack(data)
+    if version != VERSION or kind != KIND_PONG:
+        raise ProtocolError(f'Not a pong: version {version}, kind {kind}')
+    return sent_at, received_at, replied_at
+
+
+def is_newer(seq: int, last_seq: int):
+    """
+    Compares 32 bit sequence numbers with wrap-around (serial number arithmetic).
+
+    :param seq: sequence number of the received command
+    :param last_seq: sequence number of the newest command so far
+    :return: True if seq comes after last_seq
+    """
+    return 0 < (seq - last_seq) % SEQ_MODULO < SEQ_MODULO // 2
+
+
+def encode_datagram(sender_name: bytes, payload: bytes):
+    """
+    Builds UDP datagram. It has the same layout as a message forwarded by the relay over TCP: framed sender name
+    followed by the framed payload. Datagram with an empty payload registers the sender as a receiver.
+
+    :param sender_name: bytes, may carry handshake options (b'EnvSimulator;sub=RoboPies')
+    :param payload: bytes
+    :return: bytes
+    """
+    return frame(sender_name) + frame(payload)
+
+
+def decode_datagram(data):
+    """
+    Splits datagram created by encode_datagram.
+
+    :param data: bytes-like object
+    :return: sender name (str), payload (bytes)
+    """
+    try:
+        name_length = HEADER.unpack_from(data)[0]
+        payload_offset = HEADER_LENGTH + name_length
+        payload_length = HEADER.unpack_from(data, payload_offset)[0]
+    except struct.error:
+        raise ProtocolError('Truncated datagram') from None
+    if payload_offset + HEADER_LENGTH + payload_length != len(data):
+        raise ProtocolError('Datagram length does not match its headers')
+    name = bytes(data[HEADER_LENGTH:payload_offset]).decode('utf-8')
+    return name, bytes(data[payload_offset + HEADER_LENGTH:])
@@ -3,6 +3,14 @@ vec = pg.math.Vector2
 
 # Main
 MAP_NAME = 'level1.tmx'
+COMMAND_TRANSPORT = 'tcp'   # 'tcp' - reliable stream from the server, 'udp' - latest-wins datagrams
+COMMAND_TIMEOUT = 1500  # ms without commands or heartbeats after which the board's movement is dropped
+SESSION = ''    # relay session of this game, boards must use the same one
+TRACE_FILE = None   # path - log when commands arrive and are applied, merge it with trace_merge.py
+CLOCK_SYNC = True   # estimate the relay's clock, traces are then stamped with it like the board's commands
+PROFILE = True  # time the parts of every frame, 'f' shows the frame time graph
+PROFILE_FRAMES = 300    # frames kept by the profiler
+PROFILE_FILE = 'frame_profile.csv'  # written on 'l' and on quit, None disables it
 
 # Define some colors
 WHITE = (255, 255, 255)
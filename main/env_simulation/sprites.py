@@ -1,4 +1,3 @@
-import queue
 import threading
 from random import uniform, choice, randint, random
 from settings import *
@@ -7,7 +6,10 @@ import pytweening as tween
 from itertools import chain, cycle
 vec = pg.math.Vector2
 
-from client import connect_to_server, receive_commands_from_server
+from client import RECEIVE_TIMEOUT, connect_to_server, receive_commands_from_server, open_datagram_socket, \
+    receive_datagrams
+from command_mailbox import CommandMailbox
+from protocol import KIND_HAND_LOST
 
 
 def collide_with_walls(sprite, group, dir):
@@ -63,7 +65,10 @@ class Player(pg.sprite.Sprite):
         self.visible = True
         self.invisibility_timer = 0
 
-        self.commands = queue.Queue()   # Here will be put commands received from the server
+        self.commands = CommandMailbox()    # Here will be put commands received from the server
+        self.remote_move = ''   # Movement requested by the board, held between commands
+        self.last_command_time = 0
+        self.trace = game.trace
 
         # Starting new thread responsible for handling connection with the command server
         self.commands_thread_number = 0
@@ -72,16 +77,22 @@ class Player(pg.sprite.Sprite):
 
     def listen_for_commands_from_server(self):
         """
-        Connects to the local server and waits for commands. Received commands are put in the queue.
+        Connects to the local server and waits for commands. Received commands are put in the mailbox.
         To be run in separate thread.
 
         :return: none
         """
         try:
-            self.client_socket = connect_to_server('EnvSimulator')
-            receive_commands_from_server(self.client_socket, self.commands, self.quit_event)
+            if COMMAND_TRANSPORT == 'udp':
+                self.client_socket = open_datagram_socket()
+                receive_datagrams(self.client_socket, 'EnvSimulator', ['RoboPies'], self.commands, self.quit_event,
+                                  SESSION, self.trace, COMMAND_TIMEOUT / 1000)
+            else:
+                self.client_socket = connect_to_server('EnvSimulator', subscriptions=['RoboPies'], session=SESSION)
+                receive_commands_from_server(self.client_socket, self.commands, self.quit_event, self.trace)
         except Exception as e:
             print(f'Command thread failed because {e}')
+        finally:
             # Here command thread is terminated
             self.commands_thread_number -= 1
 
@@ -95,44 +106,64 @@ class Player(pg.sprite.Sprite):
         self.commands_thread = threading.Thread(target=self.listen_for_commands_from_server)
         self.commands_thread.start()
 
+    def stop_command_thread(self):
+        """
+        Stops command thread and waits until it closes its socket.
+
+        :return: none
+        """
+        self.quit_event.set()
+        self.commands_thread.join(timeout=RECEIVE_TIMEOUT + 1)
+
     def get_commands(self):
         """
-        Make actions according to received order
+        Make actions according to received orders. Movement is a state - it lasts until the board sends
+        a different one, reports that the hand was lost or goes silent for COMMAND_TIMEOUT.
 
         :return: none
         """
-        if not self.commands.empty():
-            received_command = self.commands.get()
-            speed_increase_factor = 1.5     # to compensate difference in fps between camera and Pygame simulation
-            # Movement
-            if received_command['move'] == 'up':
-                self.vel = vec(PLAYER_SPEED, 0).rotate(-self.rot) * speed_increase_factor
-            elif received_command['move'] == 'up-left':
-                self.vel = vec(PLAYER_SPEED, 0).rotate(-self.rot) * speed_increase_factor
-                self.rot_speed = PLAYER_ROT_SPEED * speed_increase_factor
-            elif received_command['move'] == 'up-right':
-                self.vel = vec(PLAYER_SPEED, 0).rotate(-self.rot) * speed_increase_factor
-                self.rot_speed = -PLAYER_ROT_SPEED * speed_increase_factor
-            elif received_command['move'] == 'left':
-                self.rot_speed = PLAYER_ROT_SPEED * speed_increase_factor
-            elif received_command['move'] == 'right':
-                self.rot_speed = -PLAYER_ROT_SPEED * speed_increase_factor
-            elif received_command['move'] == 'down':
-                self.vel = vec(-PLAYER_SPEED / 2, 0).rotate(-self.rot) * speed_increase_factor
-            elif received_command['move'] == 'down-left':
-                self.vel = vec(-PLAYER_SPEED / 2, 0).rotate(-self.rot) * speed_increase_factor
-                self.rot_speed = PLAYER_ROT_SPEED * speed_increase_factor
-            elif received_command['move'] == 'down-right':
-                self.vel = vec(-PLAYER_SPEED / 2, 0).rotate(-self.rot) * speed_increase_factor
-                self.rot_speed = -PLAYER_ROT_SPEED * speed_increase_factor
-
-            # Actions
-            if received_command['action'] == 'shoot':
+        now = pg.time.get_ticks()
+        received_command, actions = self.commands.take()
+        if received_command is not None:
+            self.last_command_time = now
+            if self.trace is not None:
+                self.trace.stamp('apply', received_command.seq)
+            if received_command.kind == KIND_HAND_LOST:
+                self.remote_move = ''
+            else:
+                self.remote_move = received_command.move
+        elif now - self.last_command_time > COMMAND_TIMEOUT:
+            self.remote_move = ''
+
+        # Movement
+        if self.remote_move == 'up':
+            self.vel = vec(PLAYER_SPEED, 0).rotate(-self.rot)
+        elif self.remote_move == 'up-left':
+            self.vel = vec(PLAYER_SPEED, 0).rotate(-self.rot)
+            self.rot_speed = PLAYER_ROT_SPEED
+        elif self.remote_move == 'up-right':
+            self.vel = vec(PLAYER_SPEED, 0).rotate(-self.rot)
+            self.rot_speed = -PLAYER_ROT_SPEED
+        elif self.remote_move == 'left':
+            self.rot_speed = PLAYER_ROT_SPEED
+        elif self.remote_move == 'right':
+            self.rot_speed = -PLAYER_ROT_SPEED
+        elif self.remote_move == 'down':
+            self.vel = vec(-PLAYER_SPEED / 2, 0).rotate(-self.rot)
+        elif self.remote_move == 'down-left':
+            self.vel = vec(-PLAYER_SPEED / 2, 0).rotate(-self.rot)
+            self.rot_speed = PLAYER_ROT_SPEED
+        elif self.remote_move == 'down-right':
+            self.vel = vec(-PLAYER_SPEED / 2, 0).rotate(-self.rot)
+            self.rot_speed = -PLAYER_ROT_SPEED
+
+        # Actions - all received since the previous frame, shooting is limited by the weapon's rate anyway
+        if received_command is not None:
+            if actions['shoot']:
                 self.shoot()
-            elif received_command['action'] == 'change':
+            for _ in range(actions['change']):
                 self.change_weapon()
 
-
     def get_keys(self):
         """
         Player's actions. Some are also in Game.events().
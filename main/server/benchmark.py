@@ -0,0 +1,229 @@
+"""
+Headless load generator and latency benchmark for the relay.
+
+Starts synthetic senders publishing commands at a fixed rate and receivers subscribed to all of them, then prints
+throughput and end-to-end latency percentiles as one JSON object. Senders and receivers are separate processes on
+the same machine, so timestamps taken with time.monotonic_ns() are comparable without any clock synchronization.
+
+Example:
+    python benchmark.py --senders 4 --receivers 2 --rate 200 --duration 10 --spawn-server
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+from array import array
+from protocol import HEADER, HEADER_LENGTH, frame, encode_command, decode_command, encode_datagram
+
+TOPIC = 'bench'
+UDP_REGISTRATION_INTERVAL = 2
+RESULT_TIMEOUT = 10     # seconds after the end of a run to wait for a process' result
+
+
+def connect(ip, port, handshake):
+    client_socket = socket.create_connection((ip, port))
+    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    client_socket.sendall(frame(handshake.encode('utf-8')))
+    return client_socket
+
+
+def run_sender(index, args, start_event, sent_queue):
+    name = f'BenchSender{index}'
+    if args.transport == 'udp':
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        name_bytes = name.encode('utf-8')
+
+        def send(payload):
+            try:
+                udp_socket.sendto(encode_datagram(name_bytes, payload), (args.ip, args.port))
+            except OSError:
+                pass    # E.g. ICMP port unreachable without a relay - the datagram is lost like any other
+    else:
+        client_socket = connect(args.ip, args.port, f'{name};pub={TOPIC}')
+
+        def send(payload):
+            client_socket.sendall(frame(payload))
+
+    start_event.wait()
+    interval = 1 / args.rate
+    start = time.perf_counter()
+    seq = 0
+    while True:
+        next_send = start + seq * interval
+        now = time.perf_counter()
+        if now - start >= args.duration:
+            break
+        if next_send > now:
+            time.sleep(next_send - now)
+        seq += 1
+        send(encode_command('up', '', seq, time.monotonic_ns()))
+    sent_queue.put(seq)
+
+
+def run_receiver(index, args, ready_queue, start_event, results):
+    name = f'BenchReceiver{index}'
+    subscriptions = ','.join(f'BenchSender{i}' for i in range(args.senders)) if args.transport == 'udp' else TOPIC
+    handshake = f'{name};sub={subscriptions}'
+    latencies = array('q')
+    received = 0
+    warmup_end = None
+
+    if args.transport == 'udp':
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_socket.bind(('', 0))
+        udp_socket.settimeout(0.2)
+        registration = encode_datagram(handshake.encode('utf-8'), b'')
+        udp_socket.sendto(registration, (args.ip, args.port))
+        last_registration = time.monotonic()
+    else:
+        client_socket = connect(args.ip, args.port, handshake)
+        client_socket.settimeout(0.2)
+        buffer = bytearray()
+    ready_queue.put(index)
+
+    deadline = None
+    while deadline is None or time.monotonic() < deadline:
+        if deadline is None and start_event.is_set():
+            # The run lasts as long as the senders plus a grace period, even if nothing arrives
+            deadline = time.monotonic() + args.duration + args.grace
+        try:
+            if args.transport == 'udp':
+                try:
+                    if time.monotonic() - last_registration > UDP_REGISTRATION_INTERVAL:
+                        last_registration = time.monotonic()
+                        udp_socket.sendto(registration, (args.ip, args.port))
+                    data = udp_socket.recv(2048)
+                except ConnectionRefusedError:
+                    continue    # ICMP port unreachable - no relay listening yet
+                messages = [data[HEADER_LENGTH + HEADER.unpack_from(data)[0] + HEADER_LENGTH:]]
+            else:
+                data = client_socket.recv(65536)
+                if not data:
+                    break
+                buffer += data
+                messages = []
+                offset = 0
+                while len(buffer) - offset >= 2 * HEADER_LENGTH:
+                    message_start = offset + HEADER_LENGTH + HEADER.unpack_from(buffer, offset)[0]
+                    if len(buffer) < message_start + HEADER_LENGTH:
+                        break
+                    message_end = message_start + HEADER_LENGTH + HEADER.unpack_from(buffer, message_start)[0]
+                    if len(buffer) < message_end:
+                        break
+                    messages.append(bytes(buffer[message_start + HEADER_LENGTH:message_end]))
+                    offset = message_end
+                del buffer[:offset]
+        except socket.timeout:
+            messages = []
+
+        now = time.monotonic_ns()
+        for message in messages:
+            if warmup_end is None:
+                warmup_end = now + int(args.warmup * 1e9)  # First message starts the warmup
+            received += 1
+            if now >= warmup_end:
+                latencies.append(now - decode_command(message).time)
+
+    results.put((index, received, latencies.tobytes()))
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+def summarize(args, sent, received, latencies, elapsed):
+    latencies.sort()
+    expected = sent * args.receivers
+    to_us = 1 / 1000
+    return {'transport': args.transport,
+            'senders': args.senders,
+            'receivers': args.receivers,
+            'rate_per_sender': args.rate,
+            'duration_s': args.duration,
+            'sent': sent,
+            'received': received,
+            'lost': expected - received,
+            'send_throughput': round(sent / elapsed, 1),
+            'receive_throughput': round(received / elapsed, 1),
+            'latency_samples': len(latencies),
+            'latency_us': {'mean': round(sum(latencies) / len(latencies) * to_us, 1) if latencies else 0,
+                           'p50': round(percentile(latencies, 50) * to_us, 1),
+                           'p99': round(percentile(latencies, 99) * to_us, 1),
+                           'p999': round(percentile(latencies, 99.9) * to_us, 1),
+                           'max': round(latencies[-1] * to_us, 1) if latencies else 0}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--senders', type=int, default=1)
+    parser.add_argument('--receivers', type=int, default=1)
+    parser.add_argument('--rate', type=float, default=100, help='messages per second of every sender')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of sending')
+    parser.add_argument('--warmup', type=float, default=1, help='seconds excluded from latency statistics')
+    parser.add_argument('--grace', type=float, default=1, help='seconds receivers wait for late messages')
+    parser.add_argument('--transport', choices=('tcp', 'udp'), default='tcp')
+    parser.add_argument('--ip', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1234)
+    parser.add_argument('--spawn-server', action='store_true', help='start server.py for the run')
+    parser.add_argument('--output', help='append JSON result to this file instead of printing it')
+    args = parser.parse_args()
+
+    server = None
+    if args.spawn_server:
+        server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                'server.py')], stdout=subprocess.DEVNULL)
+        time.sleep(0.5)
+
+    try:
+        ready_queue = multiprocessing.Queue()
+        results = multiprocessing.Queue()
+        start_event = multiprocessing.Event()
+        receivers = [multiprocessing.Process(target=run_receiver, args=(i, args, ready_queue, start_event, results))
+                     for i in range(args.receivers)]
+        for receiver in receivers:
+            receiver.start()
+        for _ in receivers:
+            ready_queue.get(timeout=10)
+        time.sleep(0.2)     # Let the relay process the handshakes
+
+        sent_queue = multiprocessing.Queue()
+        senders = [multiprocessing.Process(target=run_sender, args=(i, args, start_event, sent_queue))
+                   for i in range(args.senders)]
+        for sender in senders:
+            sender.start()
+        time.sleep(0.2)     # Let the senders connect
+        started = time.perf_counter()
+        start_event.set()
+
+        timeout = args.duration + args.grace + RESULT_TIMEOUT
+        sent = sum(sent_queue.get(timeout=timeout) for _ in senders)
+        elapsed = time.perf_counter() - started
+        received = 0
+        latencies = array('q')
+        for _ in receivers:
+            _, count, samples = results.get(timeout=timeout)
+            received += count
+            latencies.frombytes(samples)
+        for process in senders + receivers:
+            process.join()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    result = summarize(args, sent, received, list(latencies), elapsed)
+    if args.output:
+        with open(args.output, 'a') as file:
+            file.write(json.dumps(result) + '\n')
+    else:
+        print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
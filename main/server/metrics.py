@@ -0,0 +1,85 @@
+import json
+import os
+
+
+class LatencyHistogram:
+    """
+    Histogram with power of two microsecond buckets: bucket i counts values in [2**(i-1), 2**i) us.
+    Adding a value is a couple of integer operations, so it can stay on the hot path.
+    """
+    BUCKETS = 32
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total_us = 0
+        self.max_us = 0
+
+    def add(self, duration_ns):
+        us = duration_ns // 1000
+        self.counts[min(us.bit_length(), self.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total_us += us
+        if us > self.max_us:
+            self.max_us = us
+
+    def percentile(self, p):
+        """
+        Upper bound of the bucket holding given percentile.
+
+        :param p: 0 - 100
+        :return: microseconds
+        """
+        if not self.count:
+            return 0
+        rank = self.count * p / 100
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(2 ** bucket, self.max_us)
+        return self.max_us
+
+    def to_dict(self):
+        return {'count': self.count,
+                'mean_us': round(self.total_us / self.count, 1) if self.count else 0,
+                'p50_us': self.percentile(50),
+                'p99_us': self.percentile(99),
+                'max_us': self.max_us,
+                'buckets': {f'<{2 ** bucket}us': count for bucket, count in enumerate(self.counts) if count}}
+
+
+class ClientStats:
+    """
+    Traffic of one relay client. Outbound depth is sampled by the server, which owns the buffer.
+    """
+    def __init__(self):
+        self.messages_in = 0
+        self.bytes_in = 0
+        self.messages_out = 0
+        self.bytes_out = 0
+        self.max_outbound = 0
+        self.relay_time = LatencyHistogram()    # from receiving a message to writing it to this client's socket
+
+    def to_dict(self, outbound=0):
+        return {'messages_in': self.messages_in,
+                'bytes_in': self.bytes_in,
+                'messages_out': self.messages_out,
+                'bytes_out': self.bytes_out,
+                'outbound_bytes': outbound,
+                'max_outbound_bytes': self.max_outbound,
+                'relay_time': self.relay_time.to_dict()}
+
+
+def write_json(path, data):
+    """
+    Replaces the file atomically, so a reader never sees a half written snapshot.
+
+    :param path: file path
+    :param data: JSON serializable object
+    :return: none
+    """
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(data, file, indent=2)
+    os.replace(temp_path, path)
@@ -1,83 +1,678 @@
 import socket
-import select
+import selectors
+import struct
+import time
+import zlib
+import multiprocessing
+from collections import deque
+from protocol import HEADER, HEADER_LENGTH, COMMAND, ProtocolError, encode_datagram, decode_datagram, is_ping, \
+    encode_pong
+from metrics import ClientStats, LatencyHistogram, write_json
+from tracing import TraceWriter
 
 
 # default configuration
-HEADER_LENGTH = 10
 IP = '127.0.0.1'
 PORT = 1234
+RECV_SIZE = 65536
+SELECT_TIMEOUT = 10
+MAX_OUTBOUND_BUFFER = 1024 * 1024   # subscriber that falls this far behind gets disconnected
+WILDCARD = '*'  # 'sub=*' in the handshake subscribes to every sender
+UDP_PEER_TIMEOUT = 15   # seconds without a registration datagram after which UDP receiver is forgotten
+STATS_FILE = 'relay_stats.json'     # None disables statistics export
+STATS_INTERVAL = 5  # seconds between statistics snapshots
+TRACE_FILE = None   # path - log when commands enter and leave the relay, merge it with trace_merge.py
+WORKERS = 1     # more than 1 - connections are dispatched by session to that many relay processes
+DISPATCH_SIZE = 2 * RECV_SIZE   # largest hand-over message between the dispatcher and a worker
+ADDRESS = struct.Struct('!4sH')     # IPv4 address and port of a datagram passed to a worker
+RELAY_NAME = b'relay'   # sender name of the relay's own datagrams (clock sync pongs)
 
-# socket setup
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)     # solves the "Address already in use" problem
 
-server_socket.bind((IP, PORT))
-server_socket.listen()
+def parse_handshake(data):
+    """
+    Splits handshake payload into client's name and options.
 
-sockets_list = [server_socket]
-clients = {}
+    :param data: bytes, e.g. b'EnvSimulator;sub=RoboPies;session=room1'
+    :return: name, {option: [values]}
+    """
+    name, *fields = data.decode('utf-8').split(';')
+    options = {}
+    for field in fields:
+        key, _, value = field.partition('=')
+        options[key.strip()] = [v.strip() for v in value.split(',') if v.strip()]
+    return name, options
 
 
-def receive_message(client_socket):
-    try:
-        message_header = client_socket.recv(HEADER_LENGTH)
-        if not message_header:
-            return False
+def session_of(options):
+    return (options.get('session') or [''])[0]
+
+
+def pong_datagram(ping, received_at):
+    """
+    :param ping: payload of a clock sync ping
+    :param received_at: time.time_ns() when the ping arrived
+    :return: datagram answering the ping, the relay's clock is the reference of every client
+    """
+    return encode_datagram(RELAY_NAME, encode_pong(ping, received_at))
+
+
+class Client:
+    """
+    State of a single connection: name received in the handshake, bytes that do not form a full message yet
+    and bytes waiting until the socket becomes writable.
+    """
+    def __init__(self, client_socket, address):
+        self.socket = client_socket
+        self.address = address
+        self.user = None    # {'header': ..., 'data': ...} with the bare name - set after the handshake
+        self.session = ''   # clients hear only clients from the same session
+        self.topics = set()     # what this client publishes under: its name and declared 'pub' topics
+        self.subscriptions = set()
+        self.inbound = bytearray()
+        self.outbound = bytearray()
+        self.writing = False
+        self.stats = ClientStats()
+        self.queued_bytes = 0   # total ever put in outbound
+        self.sent_bytes = 0     # total ever written to the socket
+        self.in_flight = deque()    # (queued_bytes after the message, time the relay received it, traced seq)
+
+    @property
+    def name(self):
+        if self.user is None:
+            return f'{self.address[0]}:{self.address[1]}'
+        return self.user['data'].decode('utf-8')
+
+    def handshake(self, message):
+        """
+        Parses handshake message: 'name[;sub=topic,topic][;pub=topic,topic][;session=id]'. A bare name (old clients)
+        publishes under its name in the default session and subscribes to nothing.
+
+        :param message: {'header': bytes, 'data': bytes}
+        :return: none
+        """
+        name, options = parse_handshake(message['data'])
+        name = name.encode('utf-8')
+        self.user = {'header': HEADER.pack(len(name)), 'data': name}
+        self.session = session_of(options)
+        self.topics = {self.name, *options.get('pub', [])}
+        self.subscriptions = set(options.get('sub', []))
+
+    def read_messages(self):
+        """
+        Extracts complete messages from the inbound buffer.
 
-        message_length = int(message_header.decode('utf-8').strip())
-        return {'header': message_header, 'data': client_socket.recv(message_length)}
+        :return: list of {'header': bytes, 'data': bytes}
+        """
+        messages = []
+        while len(self.inbound) >= HEADER_LENGTH:
+            message_length = HEADER.unpack_from(self.inbound)[0]
+            end = HEADER_LENGTH + message_length
+            if len(self.inbound) < end:
+                break
+            messages.append({'header': bytes(self.inbound[:HEADER_LENGTH]),
+                             'data': bytes(self.inbound[HEADER_LENGTH:end])})
+            del self.inbound[:end]
+        return messages
 
-    except:
-        return False
 
+class UdpPeer:
+    """
+    Receiver registered over UDP by a datagram with an empty payload. Registration has to be repeated
+    more often than UDP_PEER_TIMEOUT.
+    """
+    def __init__(self, address, name, subscriptions, session):
+        self.address = address
+        self.name = name
+        self.subscriptions = subscriptions
+        self.session = session
+        self.last_seen = time.monotonic()
+        self.stats = ClientStats()
 
-try:
-    while True:
-        read_sockets, _, exception_sockets = select.select(sockets_list, [], sockets_list, 10)  # read list, write l, error l
 
-        for notified_socket in read_sockets:
+class RelayServer:
+    """
+    Event driven relay. Every socket is non-blocking and each client has its own outbound buffer, which is flushed
+    when the socket becomes writable, so a slow subscriber never delays forwarding to the others.
+    The same port is also open for UDP: datagrams are forwarded as they are (they share the TCP message layout)
+    to both TCP and UDP subscribers, and are never buffered - a datagram that does not fit is dropped.
 
-            # Server got a new connection
-            if notified_socket == server_socket:
-                client_socket, client_address = server_socket.accept()
+    Run as a worker of the Dispatcher (channel given), it does not listen itself - connections and datagrams
+    of its sessions arrive through the channel.
+    """
+    def __init__(self, ip=IP, port=PORT, channel=None, stats_file=STATS_FILE, trace_file=TRACE_FILE):
+        self.selector = selectors.DefaultSelector()     # epoll on Linux
+        self.clients = {}
+        self.subscribers = {}   # (session, topic) -> set of subscribed clients, WILDCARD subscribers get everything
+        self.route_counters = {}    # (session, sender name, receiver name) -> [messages, bytes]
+        self.relay_time = LatencyHistogram()
+        self.udp_sender_stats = {}  # (session, sender name) -> ClientStats
+        self.stats_file = stats_file
+        self.trace = TraceWriter(trace_file, 'relay') if trace_file else None
+        self.started = time.time()
+        self.next_stats_time = time.monotonic() + STATS_INTERVAL
 
-                user = receive_message(client_socket)
-                if user is False:
+        self.udp_peers = {}     # address -> UdpPeer
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.setblocking(False)
+        self.channel = channel
+        if channel is None:
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # solves "Address already in use"
+            self.server_socket.bind((ip, port))
+            self.server_socket.listen()
+            self.server_socket.setblocking(False)
+            self.selector.register(self.server_socket, selectors.EVENT_READ)
+
+            self.udp_socket.bind((ip, port))
+            self.selector.register(self.udp_socket, selectors.EVENT_READ)
+        else:
+            self.server_socket = None   # udp_socket is replaced by the dispatcher's bound one, see on_dispatch
+            self.selector.register(channel, selectors.EVENT_READ)
+
+    def serve_forever(self):
+        timeout = min(SELECT_TIMEOUT, STATS_INTERVAL) if self.stats_file else SELECT_TIMEOUT
+        while True:
+            for key, events in self.selector.select(timeout):
+                if key.fileobj is self.server_socket:
+                    self.accept()
+                    continue
+                if key.fileobj is self.udp_socket:
+                    self.on_datagrams()
+                    continue
+                if key.fileobj is self.channel:
+                    self.on_dispatch()
                     continue
 
-                sockets_list.append(client_socket)
-                clients[client_socket] = user
+                client = key.data
+                if events & selectors.EVENT_READ:
+                    self.on_readable(client)
+                if events & selectors.EVENT_WRITE and client.socket in self.clients:
+                    self.flush(client)
+
+            self.expire_udp_peers()
+            if self.stats_file and time.monotonic() >= self.next_stats_time:
+                self.next_stats_time += STATS_INTERVAL
+                write_json(self.stats_file, self.snapshot())
+
+    def accept(self):
+        try:
+            client_socket, client_address = self.server_socket.accept()
+        except BlockingIOError:
+            return
+        self.add_client(client_socket, client_address)
+
+    def add_client(self, client_socket, client_address, data=b''):
+        """
+        Starts serving the connection.
+
+        :param client_socket: connected socket
+        :param client_address: (ip, port)
+        :param data: bytes already read from the socket by the dispatcher
+        :return: none
+        """
+        client_socket.setblocking(False)
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client = Client(client_socket, client_address)
+        self.clients[client_socket] = client
+        self.selector.register(client_socket, selectors.EVENT_READ, client)
+        if data:
+            self.on_data(client, data)
 
-                print(f"Accepted new connection from {client_address[0]}:{client_address[1]}, username:{user['data'].decode('utf-8')}")
+    def on_dispatch(self):
+        """
+        Takes over a connection ('T' + bytes read so far, with its descriptor) or a datagram ('U' + sender's address
+        + datagram) from the dispatcher. First of all the dispatcher sends its UDP socket ('S', with its descriptor),
+        so datagrams go out from the relay's port - the worker only sends on it, reading stays with the dispatcher.
 
-            # Server got a new message
+        :return: none
+        """
+        try:
+            data, fds, _, _ = socket.recv_fds(self.channel, DISPATCH_SIZE, 1)
+        except BlockingIOError:
+            return
+        if not data:
+            raise KeyboardInterrupt     # Dispatcher is gone - shut down the same way as after Ctrl+C
+
+        if data[:1] == b'T' and fds:
+            client_socket = socket.socket(fileno=fds[0])
+            self.add_client(client_socket, client_socket.getpeername(), data[1:])
+        elif data[:1] == b'S' and fds:
+            self.udp_socket.close()
+            self.udp_socket = socket.socket(fileno=fds[0])
+        elif data[:1] == b'U':
+            ip, port = ADDRESS.unpack_from(data, 1)
+            self.on_datagram(data[1 + ADDRESS.size:], (socket.inet_ntoa(ip), port), time.perf_counter_ns())
+
+    def on_readable(self, client):
+        try:
+            data = client.socket.recv(RECV_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+
+        if not data:
+            self.close(client)
+            return
+        self.on_data(client, data)
+
+    def on_data(self, client, data):
+        received_at = time.perf_counter_ns()
+        client.stats.bytes_in += len(data)
+        client.inbound += data
+        for message in client.read_messages():
+            if client.user is None:
+                try:
+                    client.handshake(message)
+                except ValueError as e:     # UnicodeDecodeError included
+                    print(f"Rejected handshake from {client.name}: {e}")
+                    self.close(client)
+                    return
+                self.subscribe(client)
+                subscriptions = ','.join(sorted(client.subscriptions)) or '-'
+                session = f', session:{client.session}' if client.session else ''
+                print(f"Accepted new connection from {client.address[0]}:{client.address[1]}, "
+                      f"username:{client.name}, subscriptions:{subscriptions}{session}")
             else:
-                message = receive_message(notified_socket)
+                client.stats.messages_in += 1
+                self.forward(client, message, received_at)
 
-                # Client disconnected
-                if message is False:
-                    print(f"Closed connection from {clients[notified_socket]['data'].decode('utf-8')}")
-                    sockets_list.remove(notified_socket)
-                    del clients[notified_socket]
-                    continue
+    def on_datagrams(self):
+        while True:
+            try:
+                data, address = self.udp_socket.recvfrom(RECV_SIZE)
+            except (BlockingIOError, ConnectionRefusedError):
+                return
+            self.on_datagram(data, address, time.perf_counter_ns())
+
+    def on_datagram(self, data, address, received_at):
+        try:
+            name, payload = decode_datagram(data)
+        except (ProtocolError, UnicodeDecodeError):
+            return
+
+        if not payload:
+            self.register_udp_peer(address, name)
+            return
+        if is_ping(payload):
+            try:
+                self.udp_socket.sendto(pong_datagram(payload, time.time_ns() - (time.perf_counter_ns() - received_at)),
+                                       address)
+            except OSError:
+                pass    # The client pings again
+            return
+
+        session = ''
+        if ';' in name:     # Sender outside the default session - forward it under its bare name
+            name, options = parse_handshake(name.encode('utf-8'))
+            session = session_of(options)
+            data = encode_datagram(name.encode('utf-8'), payload)
+        stats = self.udp_sender_stats.setdefault((session, name), ClientStats())
+        stats.messages_in += 1
+        stats.bytes_in += len(data)
+        self.route(name, session, {name}, data, received_at, exclude=self.udp_peers.get(address))
+
+    def register_udp_peer(self, address, handshake):
+        name, options = parse_handshake(handshake.encode('utf-8'))
+        subscriptions = set(options.get('sub', []))
+        session = session_of(options)
+        peer = self.udp_peers.get(address)
+        if peer is None or peer.subscriptions != subscriptions or peer.session != session:
+            if peer is not None:
+                self.unsubscribe(peer)
+            peer = UdpPeer(address, name, subscriptions, session)
+            self.udp_peers[address] = peer
+            self.subscribe(peer)
+            session = f', session:{session}' if session else ''
+            print(f"Registered UDP receiver {address[0]}:{address[1]}, username:{name}, "
+                  f"subscriptions:{','.join(sorted(subscriptions)) or '-'}{session}")
+        peer.last_seen = time.monotonic()
+
+    def expire_udp_peers(self):
+        deadline = time.monotonic() - UDP_PEER_TIMEOUT
+        for address, peer in list(self.udp_peers.items()):
+            if peer.last_seen < deadline:
+                print(f"UDP receiver {peer.name} timed out")
+                self.unsubscribe(peer)
+                del self.udp_peers[address]
+
+    def subscribe(self, receiver):
+        for topic in receiver.subscriptions:
+            self.subscribers.setdefault((receiver.session, topic), set()).add(receiver)
+
+    def unsubscribe(self, receiver):
+        for topic in receiver.subscriptions:
+            self.subscribers[(receiver.session, topic)].discard(receiver)
+
+    def receivers(self, session, topics):
+        """
+        Finds clients of the session subscribed to any of given topics.
+
+        :param session: session id
+        :param topics: set of sender's topics
+        :return: set of Clients and UdpPeers
+        """
+        receivers = set(self.subscribers.get((session, WILDCARD), ()))
+        for topic in topics:
+            receivers.update(self.subscribers.get((session, topic), ()))
+        return receivers
+
+    def forward(self, sender, message, received_at):
+        """
+        Queues message for every client subscribed to the sender.
+
+        :param sender: Client
+        :param message: {'header': bytes, 'data': bytes}
+        :param received_at: time.perf_counter_ns() of the read that completed the message
+        :return: none
+        """
+        frame = sender.user['header'] + sender.user['data'] + message['header'] + message['data']
+        self.route(sender.name, sender.session, sender.topics, frame, received_at, exclude=sender)
 
-                user = clients[notified_socket]
+    def route(self, sender_name, session, topics, frame, received_at, exclude=None):
+        """
+        Delivers frame (framed sender name + framed message) to the subscribers of the sender.
 
-                # Broadcast message to all connected clients
-                for client_socket in clients:
-                    if client_socket != notified_socket:    # Don't send back to the sender
-                        client_socket.send(user['header']+user['data']+message['header']+message['data'])
+        :param sender_name: string
+        :param session: sender's session id
+        :param topics: set of sender's topics
+        :param frame: bytes
+        :param received_at: time.perf_counter_ns() when the relay got the message
+        :param exclude: receiver that must not get the frame back - the sender itself
+        :return: none
+        """
+        seq = self.traced_seq(frame) if self.trace else None
+        if seq is not None:
+            self.trace.stamp('relay_in', seq, time.time_ns() - (time.perf_counter_ns() - received_at))
 
-        # Deal with potential socket exceptions
-        for notified_socket in exception_sockets:
-            sockets_list.remove(notified_socket)
-            del clients[notified_socket]
+        for receiver in self.receivers(session, topics):
+            if receiver is exclude:     # Don't send back to the sender
+                continue
+            counters = self.route_counters.setdefault((session, sender_name, receiver.name), [0, 0])
+            counters[0] += 1
+            counters[1] += len(frame)
+            receiver.stats.messages_out += 1
 
-except KeyboardInterrupt:
+            if isinstance(receiver, UdpPeer):
+                try:
+                    self.udp_socket.sendto(frame, receiver.address)
+                except OSError:
+                    continue    # Latest-wins transport - a dropped datagram is superseded by the next one
+                receiver.stats.bytes_out += len(frame)
+                if seq is not None:
+                    self.trace.stamp('relay_out', seq)
+                relay_time = time.perf_counter_ns() - received_at
+                receiver.stats.relay_time.add(relay_time)
+                self.relay_time.add(relay_time)
+                continue
+
+            receiver.outbound += frame
+            receiver.queued_bytes += len(frame)
+            receiver.in_flight.append((receiver.queued_bytes, received_at, seq))
+            if len(receiver.outbound) > receiver.stats.max_outbound:
+                receiver.stats.max_outbound = len(receiver.outbound)
+            if len(receiver.outbound) > MAX_OUTBOUND_BUFFER:
+                print(f'Dropping slow client {receiver.name}')
+                self.close(receiver)
+                continue
+            if not receiver.writing:
+                self.flush(receiver)
+
+    @staticmethod
+    def traced_seq(frame):
+        """
+        :param frame: framed sender name + framed message
+        :return: sequence number of the command carried by the frame or None for other messages
+        """
+        offset = len(frame) - COMMAND.size
+        if offset < HEADER_LENGTH or HEADER.unpack_from(frame, offset - HEADER_LENGTH)[0] != COMMAND.size:
+            return None
+        return COMMAND.unpack_from(frame, offset)[4]
+
+    def flush(self, client):
+        """
+        Sends as much of the outbound buffer as the socket accepts and waits for writability if anything is left.
+
+        :param client: Client
+        :return: none
+        """
+        try:
+            sent = client.socket.send(client.outbound)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.close(client)
+            return
+        del client.outbound[:sent]
+
+        if sent:
+            client.sent_bytes += sent
+            client.stats.bytes_out += sent
+            now = time.perf_counter_ns()
+            while client.in_flight and client.in_flight[0][0] <= client.sent_bytes:
+                _, received_at, seq = client.in_flight.popleft()
+                relay_time = now - received_at
+                if seq is not None:
+                    self.trace.stamp('relay_out', seq)
+                client.stats.relay_time.add(relay_time)
+                self.relay_time.add(relay_time)
+
+        pending = len(client.outbound) > 0
+        if pending != client.writing:
+            client.writing = pending
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE if pending else selectors.EVENT_READ
+            self.selector.modify(client.socket, events, client)
+
+    def close(self, client):
+        if client.socket not in self.clients:
+            return
+        if client.user is not None:
+            print(f"Closed connection from {client.name}")
+        self.unsubscribe(client)
+        self.selector.unregister(client.socket)
+        del self.clients[client.socket]
+        client.socket.close()
+
+    def shutdown(self):
+        for client in list(self.clients.values()):
+            self.close(client)
+        if self.server_socket is not None:
+            try:
+                self.selector.unregister(self.server_socket)
+                self.server_socket.shutdown(socket.SHUT_RDWR)
+            except (OSError, KeyError):
+                pass
+            self.server_socket.close()
+        self.udp_socket.close()
+        self.selector.close()
+        if self.trace is not None:
+            self.trace.close()
+
+    def snapshot(self):
+        """
+        Collects relay statistics.
+
+        :return: JSON serializable dictionary
+        """
+        return {'time': time.time(),
+                'uptime_s': round(time.time() - self.started, 1),
+                'relay_time': self.relay_time.to_dict(),
+                'clients': [{'name': client.name, 'session': client.session, 'transport': 'tcp',
+                             **client.stats.to_dict(len(client.outbound))}
+                            for client in self.clients.values()],
+                'udp_receivers': [{'name': peer.name, 'session': peer.session, 'transport': 'udp',
+                                   **peer.stats.to_dict()}
+                                  for peer in self.udp_peers.values()],
+                'udp_senders': [{'name': name, 'session': session, 'transport': 'udp', **stats.to_dict()}
+                                for (session, name), stats in self.udp_sender_stats.items()],
+                'routes': [{'session': session, 'from': sender, 'to': receiver, 'messages': messages,
+                            'bytes': sent_bytes}
+                           for (session, sender, receiver), (messages, sent_bytes) in self.route_counters.items()]}
+
+    def print_route_counters(self):
+        for (session, sender, receiver), (messages, sent_bytes) in sorted(self.route_counters.items()):
+            session = f'[{session}] ' if session else ''
+            print(f'{session}{sender} -> {receiver}: {messages} messages, {sent_bytes} bytes')
+
+
+def run_worker(index, channel):
+    """
+    Entry point of a worker process started by the Dispatcher.
+
+    :param index: worker number
+    :param channel: worker's end of the socket pair connected to the dispatcher
+    :return: none
+    """
+    stats_file = f'{STATS_FILE[:-len(".json")]}.{index}.json' if STATS_FILE else None
+    trace_file = f'{TRACE_FILE}.{index}' if TRACE_FILE else None
+    server = RelayServer(channel=channel, stats_file=stats_file, trace_file=trace_file)
     try:
-        if server_socket is not None:
-            server_socket.shutdown(socket.SHUT_RDWR)
-            server_socket.close()
-    except socket.error:
-        pass
-    print("Server closed.")
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+        server.print_route_counters()
+
+
+class Dispatcher:
+    """
+    Spreads the relay over several worker processes. It accepts connections, reads them until the handshake is
+    complete and passes the socket, with the bytes read so far, to the worker chosen by hashing the session id,
+    so both ends of a session always meet in one process. Datagrams are passed the same way. Plain SO_REUSEPORT
+    is not enough here - the kernel would spread one session's connections over different processes.
+    """
+    def __init__(self, workers=WORKERS, ip=IP, port=PORT):
+        self.channels = []
+        self.workers = []
+        for index in range(workers):    # Before opening any socket, so workers do not inherit them
+            channel, worker_channel = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            worker = multiprocessing.Process(target=run_worker, args=(index, worker_channel), daemon=True)
+            worker.start()
+            worker_channel.close()
+            self.channels.append(channel)
+            self.workers.append(worker)
+
+        self.selector = selectors.DefaultSelector()
+        self.pending = {}   # socket -> bytes received before the handshake was complete
+
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind((ip, port))
+        self.server_socket.listen()
+        self.server_socket.setblocking(False)
+        self.selector.register(self.server_socket, selectors.EVENT_READ)
+
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.bind((ip, port))
+        self.udp_socket.setblocking(False)
+        self.selector.register(self.udp_socket, selectors.EVENT_READ)
+        for channel in self.channels:   # Workers send their datagrams through it
+            socket.send_fds(channel, [b'S'], [self.udp_socket.fileno()])
+
+    def channel_for(self, session):
+        return self.channels[zlib.crc32(session.encode('utf-8')) % len(self.channels)]
+
+    def serve_forever(self):
+        while True:
+            for key, _ in self.selector.select(SELECT_TIMEOUT):
+                if key.fileobj is self.server_socket:
+                    try:
+                        client_socket, _ = self.server_socket.accept()
+                    except BlockingIOError:
+                        continue
+                    client_socket.setblocking(False)
+                    self.pending[client_socket] = b''
+                    self.selector.register(client_socket, selectors.EVENT_READ)
+                elif key.fileobj is self.udp_socket:
+                    self.on_datagrams()
+                else:
+                    self.on_handshake_data(key.fileobj)
+
+    def on_handshake_data(self, client_socket):
+        try:
+            data = client_socket.recv(RECV_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.drop(client_socket)
+            return
+
+        data = self.pending[client_socket] + data
+        self.pending[client_socket] = data
+        if len(data) < HEADER_LENGTH or len(data) < HEADER_LENGTH + HEADER.unpack_from(data)[0]:
+            return
+
+        try:
+            _, options = parse_handshake(data[HEADER_LENGTH:HEADER_LENGTH + HEADER.unpack_from(data)[0]])
+        except ValueError as e:     # UnicodeDecodeError included
+            print(f"Rejected handshake: {e}")
+            self.drop(client_socket)
+            return
+        channel = self.channel_for(session_of(options))
+        socket.send_fds(channel, [b'T' + data], [client_socket.fileno()])
+        self.drop(client_socket)    # The worker has its own descriptor now
+
+    def on_datagrams(self):
+        while True:
+            try:
+                data, address = self.udp_socket.recvfrom(RECV_SIZE)
+            except (BlockingIOError, ConnectionRefusedError):
+                return
+            received_at = time.time_ns()
+            try:
+                name, payload = decode_datagram(data)
+            except (ProtocolError, UnicodeDecodeError):
+                continue
+            if is_ping(payload):    # Answered here - a detour through a worker would only add delay
+                try:
+                    self.udp_socket.sendto(pong_datagram(payload, received_at), address)
+                except OSError:
+                    pass
+                continue
+            _, options = parse_handshake(name.encode('utf-8'))
+            header = b'U' + ADDRESS.pack(socket.inet_aton(address[0]), address[1])
+            try:
+                self.channel_for(session_of(options)).send(header + data, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                pass    # Worker is busy - latest-wins datagram can be dropped
+
+    def drop(self, client_socket):
+        self.selector.unregister(client_socket)
+        del self.pending[client_socket]
+        client_socket.close()
+
+    def shutdown(self):
+        for client_socket in list(self.pending):
+            self.drop(client_socket)
+        for channel in self.channels:
+            channel.shutdown(socket.SHUT_RDWR)  # Workers shut down on EOF; later workers hold copies of the channel
+            channel.close()
+        for worker in self.workers:
+            worker.join(timeout=5)
+        self.server_socket.close()
+        self.udp_socket.close()
+        self.selector.close()
+
+
+def main():
+    if WORKERS > 1:
+        dispatcher = Dispatcher()
+        try:
+            dispatcher.serve_forever()
+        except KeyboardInterrupt:
+            dispatcher.shutdown()
+            print("Server closed.")
+        return
+
+    server = RelayServer()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+        server.print_route_counters()
+        print("Server closed.")
+
+
+if __name__ == '__main__':
+    main()
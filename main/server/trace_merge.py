@@ -0,0 +1,95 @@
+"""
+Merges trace logs of the board (sender.py), the relay and the game into a per-stage latency breakdown.
+
+Commands are matched by sequence number, so every log has to come from the same run with one board. With CLOCK_SYNC
+on, the board and the game stamp in the relay's time and the logs line up as they are; otherwise stamps are wall clock
+times of each host - pass the offset of every log relative to the relay.
+
+Example:
+    python trace_merge.py board.trace relay.trace game.trace --offset game=-3.2
+"""
+import argparse
+import csv
+import sys
+from tracing import STAGES, read_trace
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+def merge(paths, offsets):
+    """
+    :param paths: trace log paths
+    :param offsets: {process name: ms to add to its stamps}
+    :return: {seq: {stage: time in ns}}
+    """
+    commands = {}
+    for path in paths:
+        name, records = read_trace(path)
+        offset = int(offsets.get(name, 0) * 1e6)
+        for stage, seq, time_ns in records:
+            stages = commands.setdefault(seq, {})
+            time_ns += offset
+            if stage not in stages or time_ns < stages[stage]:     # First receiver of a relayed command counts
+                stages[stage] = time_ns
+    return commands
+
+
+def breakdown(commands):
+    """
+    :param commands: result of merge()
+    :return: {segment name: sorted list of durations in ms}, segments in the order of STAGES, 'total' last
+    """
+    segments = {}
+    for stages in commands.values():
+        present = [stage for stage in STAGES if stage in stages]
+        for previous, stage in zip(present, present[1:]):
+            segments.setdefault(f'{previous} -> {stage}', []).append((stages[stage] - stages[previous]) / 1e6)
+        if len(present) > 1:
+            segments.setdefault(f'total {present[0]} -> {present[-1]}', []).append(
+                (stages[present[-1]] - stages[present[0]]) / 1e6)
+
+    order = {f'{previous} -> {stage}': index for index, (previous, stage) in enumerate(zip(STAGES, STAGES[1:]))}
+    return {segment: sorted(segments[segment])
+            for segment in sorted(segments, key=lambda segment: order.get(segment, len(order)))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('traces', nargs='+')
+    parser.add_argument('--offset', action='append', default=[], metavar='PROCESS=MS',
+                        help="clock offset added to the stamps of a process ('board', 'relay' or 'game')")
+    parser.add_argument('--csv', help='write the breakdown to this file instead of printing it')
+    args = parser.parse_args()
+
+    offsets = {}
+    for option in args.offset:
+        name, _, value = option.partition('=')
+        offsets[name] = float(value)
+
+    commands = merge(args.traces, offsets)
+    applied = sum(1 for stages in commands.values() if 'apply' in stages)
+    rows = [(segment, len(values), round(sum(values) / len(values), 3), round(percentile(values, 50), 3),
+             round(percentile(values, 99), 3), round(values[-1], 3))
+            for segment, values in breakdown(commands).items()]
+
+    if args.csv:
+        with open(args.csv, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['segment', 'count', 'mean_ms', 'p50_ms', 'p99_ms', 'max_ms'])
+            writer.writerows(rows)
+        return
+
+    print(f'{len(commands)} commands traced, {applied} applied in the game '
+          f'(the rest was superseded before a game frame)')
+    width = max((len(row[0]) for row in rows), default=0)
+    print(f"{'segment':<{width}}  {'count':>7}  {'mean ms':>9}  {'p50 ms':>9}  {'p99 ms':>9}  {'max ms':>9}")
+    for segment, count, mean, p50, p99, maximum in rows:
+        print(f'{segment:<{width}}  {count:>7}  {mean:>9}  {p50:>9}  {p99:>9}  {maximum:>9}')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+import json
+import os
+import time
+import cv2
+
+# Modes tried while probing: width, height, fps, pixel format
+CANDIDATE_MODES = [(width, height, fps, fourcc)
+                   for fourcc in ('MJPG', 'YUYV')
+                   for width, height in ((320, 240), (640, 480), (800, 600), (1280, 720))
+                   for fps in (60, 30)]
+PROBE_FRAMES = 30
+WARMUP_FRAMES = 5
+IDLE_TIME = 0.2     # seconds without reading, lets the driver fill its buffer before the latency probe
+
+
+def apply_mode(capture, width, height, fps, fourcc):
+    capture.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc))
+    capture.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+    capture.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+    capture.set(cv2.CAP_PROP_FPS, fps)
+    capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)     # Not every backend supports it, the probe measures what is left
+
+
+def measure(capture):
+    """
+    Measures the delivered FPS and how old frames are when read. After a pause the driver's buffer is full, so
+    the frames that come back at once are stale; their count times the frame interval is the buffering latency.
+
+    :param capture: configured cv2.VideoCapture
+    :return: fps, latency in ms
+    """
+    for _ in range(WARMUP_FRAMES):
+        capture.read()
+
+    start = time.perf_counter()
+    for _ in range(PROBE_FRAMES):
+        capture.grab()
+    fps = PROBE_FRAMES / (time.perf_counter() - start)
+    interval = 1 / fps
+
+    time.sleep(IDLE_TIME)
+    stale = 0
+    while stale < PROBE_FRAMES:
+        start = time.perf_counter()
+        capture.grab()
+        if time.perf_counter() - start > interval / 2:
+            break   # Waited for a new frame - the buffer is empty
+        stale += 1
+    return fps, (stale + 1) * interval * 1000
+
+
+def probe(index, min_width, min_height):
+    """
+    Tries CANDIDATE_MODES and picks the one with the lowest latency among those giving at least the requested
+    resolution.
+
+    :param index: camera index
+    :param min_width: pixels
+    :param min_height: pixels
+    :return: dict describing the mode or None when no mode works
+    """
+    best = None
+    capture = cv2.VideoCapture(index)
+    try:
+        for width, height, fps, fourcc in CANDIDATE_MODES:
+            apply_mode(capture, width, height, fps, fourcc)
+            actual_width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+            actual_height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            if (actual_width, actual_height) != (width, height) or width < min_width or height < min_height:
+                continue
+            if not capture.read()[0]:
+                continue
+            measured_fps, latency = measure(capture)
+            mode = {'width': width, 'height': height, 'fps': fps, 'fourcc': fourcc,
+                    'measured_fps': round(measured_fps, 1), 'latency_ms': round(latency, 1)}
+            print(f'Camera mode {width}x{height} {fourcc} @{fps}: {mode["measured_fps"]} FPS, '
+                  f'{mode["latency_ms"]} ms latency')
+            # Lower latency wins, then higher FPS, then lower resolution (cheaper to process)
+            key = (mode['latency_ms'], -mode['measured_fps'], width * height)
+            if best is None or key < (best['latency_ms'], -best['measured_fps'], best['width'] * best['height']):
+                best = mode
+    finally:
+        capture.release()
+    return best
+
+
+def open_camera(index=0, min_width=640, min_height=480, profile_file='camera_profile.json'):
+    """
+    Opens the camera in its lowest latency mode. The mode found by probing is saved in profile_file, so later
+    startups skip the probe; delete the file after changing the camera.
+
+    :param index: camera index
+    :param min_width: pixels
+    :param min_height: pixels
+    :param profile_file: path or None to probe every time
+    :return: cv2.VideoCapture
+    """
+    key = f'{index}:{min_width}x{min_height}'
+    profiles = {}
+    if profile_file and os.path.exists(profile_file):
+        with open(profile_file) as file:
+            profiles = json.load(file)
+
+    mode = profiles.get(key)
+    if mode is None:
+        mode = probe(index, min_width, min_height)
+        if mode is not None and profile_file:
+            profiles[key] = mode
+            with open(profile_file, 'w') as file:
+                json.dump(profiles, file, indent=2)
+
+    capture = cv2.VideoCapture(index)
+    if mode is not None:
+        apply_mode(capture, mode['width'], mode['height'], mode['fps'], mode['fourcc'])
+    else:
+        capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    return capture
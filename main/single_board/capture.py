@@ -0,0 +1,83 @@
+import threading
+import time
+
+
+class FrameGrabber:
+    """
+    Reads the camera on its own thread and keeps only the newest frame. Frames the consumer did not take in time
+    are overwritten (and counted as dropped), so processing always starts on the freshest image and the camera
+    driver's buffer never fills up.
+    """
+    def __init__(self, capture):
+        """
+        :param capture: opened cv2.VideoCapture or any object with read() and release()
+        """
+        self.capture = capture
+        self.condition = threading.Condition()
+        self.frame = None
+        self.frame_time = 0     # time.perf_counter_ns() when the newest frame was read
+        self.frame_number = 0   # number of the newest frame, 0 - nothing read yet
+        self.taken_number = 0   # number of the frame returned by the last read()
+        self.running = False
+        self.thread = None
+        self.captured = 0
+        self.dropped = 0
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.grab_frames, daemon=True)
+        self.thread.start()
+        return self
+
+    def grab_frames(self):
+        try:
+            while self.running:
+                success, img = self.capture.read()
+                if not success:
+                    break
+                now = time.perf_counter_ns()
+                with self.condition:
+                    if self.frame_number != self.taken_number:
+                        self.dropped += 1
+                    self.frame = img
+                    self.frame_time = now
+                    self.frame_number += 1
+                    self.captured += 1
+                    self.condition.notify()
+        finally:
+            with self.condition:
+                self.running = False
+                self.condition.notify_all()
+
+    def read(self, timeout=None):
+        """
+        Waits for a frame newer than the one returned last time.
+
+        :param timeout: seconds or None to wait as long as the camera works
+        :return: success, image - the same as cv2.VideoCapture.read()
+        """
+        success, img, _ = self.read_timed(timeout)
+        return success, img
+
+    def read_timed(self, timeout=None):
+        """
+        The same as read(), with the time the camera delivered the frame - it may have waited here since then.
+
+        :param timeout: seconds or None to wait as long as the camera works
+        :return: success, image, time.perf_counter_ns() when the frame was read from the camera
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.frame_number != self.taken_number or not self.running, timeout)
+            if self.frame_number == self.taken_number:
+                return False, None, 0
+            self.taken_number = self.frame_number
+            return True, self.frame, self.frame_time
+
+    def stats(self):
+        return {'captured': self.captured, 'dropped': self.dropped}
+
+    def release(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout=1)
+        self.capture.release()
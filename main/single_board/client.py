@@ -1,33 +1,134 @@
 import socket
-import pickle
+import time
+from protocol import KIND_COMMAND, KIND_HEARTBEAT, KIND_HAND_LOST, frame, encode_command, encode_datagram
 
 
 # Default configuration
-HEADER_LENGTH = 10
 IP = '127.0.0.1'
 PORT = 1234
+UDP_ADDRESS = (IP, PORT)   # relay; point it at the game's UDP port (1235) to skip the relay
 
 
-def connect_to_server(client_name: str):
+def handshake_name(client_name: str, subscriptions=(), session=''):
+    """
+    Adds handshake options to the client's name.
+
+    :param client_name: string
+    :param subscriptions: names (or topics) of the clients whose messages the server should forward to this one
+    :param session: id of the game session, clients of different sessions never hear each other
+    :return: string, e.g. 'EnvSimulator;sub=RoboPies;session=room1'
+    """
+    if subscriptions:
+        client_name += ';sub=' + ','.join(subscriptions)
+    if session:
+        client_name += f';session={session}'
+    return client_name
+
+
+def connect_to_server(client_name: str, subscriptions=(), session=''):
     """
     Connects to the local server.
 
     :param client_name: string
+    :param subscriptions: names (or topics) of the clients whose messages the server should forward to this one
+    :param session: id of the game session
     :return: client's socket
     """
-    client_name = client_name.encode('utf-8')
-    client_name_header = f'{len(client_name):<{HEADER_LENGTH}}'.encode('utf-8')
+    client_name = handshake_name(client_name, subscriptions, session)
 
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     client_socket.connect((IP, PORT))
+    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     client_socket.setblocking(False)
 
-    client_socket.send(client_name_header + client_name)    # Send id to the server
+    client_socket.send(frame(client_name.encode('utf-8')))    # Send id to the server
 
     return client_socket
 
 
-def send_object_message(client_socket, message: object):
-    message = pickle.dumps(message)
-    message_header = bytes(f'{len(message):<{HEADER_LENGTH}}', 'utf-8')
-    client_socket.send(message_header + message)
+def send_message(client_socket, message: bytes):
+    client_socket.send(frame(message))
+
+
+def open_datagram_socket():
+    """
+    Creates UDP socket for the latest-wins transport.
+
+    :return: client's socket
+    """
+    return socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+
+def send_datagram(udp_socket, client_name: str, message: bytes, address=UDP_ADDRESS):
+    try:
+        udp_socket.sendto(encode_datagram(client_name.encode('utf-8'), message), address)
+    except OSError:
+        pass    # Nothing to retransmit - the next command supersedes this one
+
+
+class CommandSender:
+    """
+    Numbers commands and decides which of them go out. With only_changes set a command is sent only when
+    the movement changes or an action is requested; a heartbeat repeating the current movement is sent after
+    heartbeat_interval seconds of silence, so the receiver can tell a steady gesture from a dead board.
+    """
+    def __init__(self, send, only_changes=True, heartbeat_interval=0.5, send_time_info=True, clock=time.time_ns):
+        """
+        :param send: function sending encoded command, e.g. partial(send_message, client_socket)
+        :param only_changes: bool
+        :param heartbeat_interval: seconds
+        :param send_time_info: whether to put the send time in the commands
+        :param clock: function giving the send time in ns, ClockSync.now makes it comparable on other hosts
+        """
+        self.send = send
+        self.only_changes = only_changes
+        self.heartbeat_interval = heartbeat_interval
+        self.send_time_info = send_time_info
+        self.clock = clock
+        self.seq = 0
+        self.move = None    # last sent movement, None when no hand is visible
+        self.last_send_time = 0
+        self.sent_at = 0    # clock() of the last command
+        self.sent = 0
+        self.suppressed = 0
+
+    def send_command(self, move, action, kind=KIND_COMMAND):
+        self.seq += 1
+        self.sent_at = self.clock()
+        timestamp = self.sent_at if self.send_time_info else 0
+        self.send(encode_command(move, action, self.seq, timestamp, kind))
+        self.last_send_time = time.monotonic()
+        self.sent += 1
+
+    def update(self, move, action):
+        """
+        To be called for every frame with a detected hand.
+
+        :param move: interpreted movement
+        :param action: '' or one-off action
+        :return: none
+        """
+        if not self.only_changes or move != self.move or action:
+            self.send_command(move, action)
+        else:
+            self.suppressed += 1
+        self.move = move
+
+    def hand_lost(self):
+        """
+        To be called for every frame without a hand - tells the receiver once that the hand is gone.
+
+        :return: none
+        """
+        if self.move is not None:
+            self.send_command('', '', KIND_HAND_LOST)
+            self.move = None
+
+    def heartbeat(self):
+        """
+        To be called once per frame, sends heartbeat if nothing was sent for heartbeat_interval.
+
+        :return: none
+        """
+        if time.monotonic() - self.last_send_time >= self.heartbeat_interval:
+            self.send_command(self.move or '', '', KIND_HEARTBEAT)
@@ -0,0 +1,103 @@
+from collections import Counter, deque
+
+# Finger bits of the mask, in the order of HandDetector.fingers_up()
+THUMB, INDEX, MIDDLE, RING, PINKY = (1 << bit for bit in range(5))
+ALL_FINGERS = THUMB | INDEX | MIDDLE | RING | PINKY
+
+# Action -> fingers that have to be up to hold it. Earlier actions win when several start in the same frame.
+ACTION_FINGERS = {'shoot': INDEX,
+                  'change': MIDDLE}
+PAUSE_MASKS = (ALL_FINGERS,)    # open hand - gestures are ignored
+PAUSED = -1     # table entry of a pause mask
+
+
+def finger_mask(fingers):
+    """
+    :param fingers: 5 ints or bools from HandDetector.fingers_up()
+    :return: int, bit i set when finger i is up
+    """
+    mask = 0
+    for bit, up in enumerate(fingers):
+        if up:
+            mask |= 1 << bit
+    return mask
+
+
+def build_table(action_fingers=ACTION_FINGERS, pause_masks=PAUSE_MASKS):
+    """
+    Precomputes the actions held by every finger mask.
+
+    :param action_fingers: {action: mask of the fingers that have to be up}
+    :param pause_masks: masks for which gestures are ignored
+    :return: list of 32 ints - bit i set when the i-th action is held, or PAUSED
+    """
+    table = []
+    for mask in range(ALL_FINGERS + 1):
+        held = 0
+        for bit, fingers in enumerate(action_fingers.values()):
+            if mask & fingers == fingers:
+                held |= 1 << bit
+        table.append(PAUSED if mask in pause_masks else held)
+    return table
+
+
+class GestureEngine:
+    """
+    Turns raised fingers into actions. A finger mask is accepted only after it wins votes of the last window frames,
+    so a single misdetected frame neither fires nor cancels anything. Actions are edge events: an action is emitted
+    once when its fingers go up and again only after they went down.
+    """
+    def __init__(self, window=3, votes=2, action_fingers=ACTION_FINGERS, pause_masks=PAUSE_MASKS):
+        """
+        :param window: number of recent frames taking part in the vote
+        :param votes: frames of the window that have to agree before the mask changes
+        :param action_fingers: {action: mask of the fingers that have to be up}
+        :param pause_masks: masks for which gestures are ignored
+        """
+        self.actions = tuple(action_fingers)
+        self.table = build_table(action_fingers, pause_masks)
+        self.votes = votes
+        self.recent = deque(maxlen=window)
+        self.mask = None    # accepted mask
+        self.held = 0       # actions held by the last accepted, not paused mask
+        self.pending = 0    # actions that started but were not emitted yet
+
+    def update(self, fingers):
+        """
+        Called for every frame with a hand.
+
+        :param fingers: 5 ints or bools from HandDetector.fingers_up()
+        :return: active (False when the hand pauses gestures), action ('' or one of the actions)
+        """
+        mask = finger_mask(fingers)
+        self.recent.append(mask)
+        if mask != self.mask:
+            candidate, count = Counter(self.recent).most_common(1)[0]
+            if count >= self.votes:
+                self.mask = candidate
+        if self.mask is None:   # New hand, not confirmed yet
+            return False, ''
+
+        held = self.table[self.mask]
+        if held == PAUSED:
+            self.pending = 0
+            return False, ''
+
+        self.pending = (self.pending | (held & ~self.held)) & held
+        self.held = held
+        if not self.pending:
+            return True, ''
+        bit = (self.pending & -self.pending).bit_length() - 1   # lowest pending bit - earliest action
+        self.pending &= ~(1 << bit)
+        return True, self.actions[bit]
+
+    def reset(self):
+        """
+        Forgets the hand, e.g. after it left the frame.
+
+        :return: none
+        """
+        self.recent.clear()
+        self.mask = None
+        self.held = 0
+        self.pending = 0
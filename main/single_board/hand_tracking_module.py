@@ -1,83 +1,180 @@
 import cv2
-import mediapipe as mp
+import numpy as np
+
+LANDMARKS = 21   # per hand
 
 
 class HandDetector:
-    def __init__(self, mode=False, max_hands=2, detection_con=0.5, track_con=0.5):
+    def __init__(self, mode=False, max_hands=2, detection_con=0.5, track_con=0.5, roi_tracking=False,
+                 roi_padding=0.5, roi_max_side=256):
+        """
+        :param roi_tracking: once hands are found, look for them only in a crop around their previous position
+        :param roi_padding: margin added on every side of the hands' bbox, as a fraction of its longer side
+        :param roi_max_side: crop is scaled down to at most this many pixels before inference
+        """
         self.mode = mode
         self.max_hands = max_hands
         self.detection_con = detection_con
         self.track_con = track_con
+        self.roi_tracking = roi_tracking
+        self.roi_padding = roi_padding
+        self.roi_max_side = roi_max_side
 
+        import mediapipe as mp  # Imported here, so loading it can overlap with opening the camera
         self.mp_hands = mp.solutions.hands
         self.hands = self.mp_hands.Hands(self.mode, self.max_hands, self.detection_con, self.track_con)
         self.mp_draw = mp.solutions.drawing_utils
 
-        self.tip_ids = [4, 8, 12, 16, 20]
+        # Crops move from frame to frame, so they get their own graph and do not disturb tracking of full frames
+        self.roi_hands = self.mp_hands.Hands(self.mode, self.max_hands, self.detection_con, self.track_con) \
+            if roi_tracking else None
+        self.roi = None     # x_min, y_min, x_max, y_max of the hands in the last frame, normalized
+        self.roi_frames = 0
+        self.full_frames = 0
+
+        self.tip_ids = np.array([4, 8, 12, 16, 20])
+        self.landmarks = np.empty((0, LANDMARKS, 3), dtype=np.float32)  # (hands, 21, 3) normalized x, y, z
+        self.pixels = np.empty((0, LANDMARKS, 2), dtype=np.int32)   # (hands, 21, 2) x, y in pixels
+        self.bboxes = np.empty((0, 4), dtype=np.int32)  # (hands, 4) x_min, y_min, x_max, y_max
+        self.centers = np.empty((0, 2), dtype=np.int32)
+        self.fingers = np.empty((0, 5), dtype=np.int8)  # (hands, 5) 1 - finger is up
+        self.hand_num = 0
 
     def find_hands(self, img, draw=True):
-        img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        self.results = self.hands.process(img_rgb)
+        self.results = None
+        if self.roi is not None:
+            self.results = self.process_roi(img)
+        if self.results is None:
+            img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+            self.results = self.hands.process(img_rgb)
+            self.full_frames += 1
 
         if self.results.multi_hand_landmarks:
             for hand_landmarks in self.results.multi_hand_landmarks:
                 if draw:
                     self.mp_draw.draw_landmarks(img, hand_landmarks, self.mp_hands.HAND_CONNECTIONS)
+        hands = self.results.multi_hand_landmarks or []
+        self.landmarks = np.array([[(landmark.x, landmark.y, landmark.z) for landmark in hand.landmark]
+                                   for hand in hands], dtype=np.float32).reshape(len(hands), LANDMARKS, 3)
+        if self.roi_tracking:
+            self.roi = self.hands_bbox()
         return img
 
+    def set_landmarks(self, landmarks):
+        """
+        Replaces landmarks of the current frame with ones found another way, e.g. by optical flow tracking.
+
+        :param landmarks: (hands, 21, 3) normalized
+        :return: none
+        """
+        self.landmarks = landmarks
+        if self.roi_tracking:
+            self.roi = self.hands_bbox()
+
+    def process_roi(self, img):
+        """
+        Runs inference on a padded, square crop around the previous position of the hands and maps the landmarks
+        back to the whole frame.
+
+        :param img: BGR frame
+        :return: MediaPipe results or None when the hands were lost or found with too low confidence
+        """
+        height, width, _ = img.shape
+        x_min, y_min, x_max, y_max = self.roi
+        side = max((x_max - x_min) * width, (y_max - y_min) * height) * (1 + 2 * self.roi_padding)
+        center_x, center_y = (x_min + x_max) / 2 * width, (y_min + y_max) / 2 * height
+        left, top = max(0, int(center_x - side / 2)), max(0, int(center_y - side / 2))
+        right, bottom = min(width, int(center_x + side / 2)), min(height, int(center_y + side / 2))
+        if right - left < 2 or bottom - top < 2:
+            return None
+
+        crop = img[top:bottom, left:right]
+        scale = self.roi_max_side / max(right - left, bottom - top)
+        if scale < 1:
+            crop = cv2.resize(crop, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        results = self.roi_hands.process(cv2.cvtColor(crop, cv2.COLOR_BGR2RGB))
+        if not results.multi_hand_landmarks:
+            return None
+        if min(hand.classification[0].score for hand in results.multi_handedness) < self.track_con:
+            return None
+
+        for hand_landmarks in results.multi_hand_landmarks:
+            for landmark in hand_landmarks.landmark:
+                landmark.x = (left + landmark.x * (right - left)) / width
+                landmark.y = (top + landmark.y * (bottom - top)) / height
+        self.roi_frames += 1
+        return results
+
+    def hands_bbox(self):
+        """
+        :return: normalized x_min, y_min, x_max, y_max of all detected hands or None
+        """
+        if not len(self.landmarks):
+            return None
+        points = self.landmarks[:, :, :2].reshape(-1, 2)
+        return (*points.min(axis=0).tolist(), *points.max(axis=0).tolist())
+
+    def process_landmarks(self, width, height):
+        """
+        Computes pixel positions, bboxes, centers and raised fingers of all detected hands at once.
+
+        :param width: frame width
+        :param height: frame height
+        :return: none
+        """
+        self.pixels = (self.landmarks[:, :, :2] * np.array((width, height), dtype=np.float32)).astype(np.int32)
+        self.bboxes = np.concatenate((self.pixels.min(axis=1), self.pixels.max(axis=1)), axis=1)
+        self.centers = (self.bboxes[:, 2:] - self.bboxes[:, :2]) // 2 + self.bboxes[:, :2]
+
+        tips = self.pixels[:, self.tip_ids]
+        self.fingers = np.empty((len(self.pixels), len(self.tip_ids)), dtype=np.int8)
+        self.fingers[:, 0] = tips[:, 0, 0] < self.pixels[:, self.tip_ids[0] - 1, 0]     # thumb
+        self.fingers[:, 1:] = tips[:, 1:, 1] < self.pixels[:, self.tip_ids[1:] - 2, 1]
+
     def find_position_and_bbox(self, img, hand_num=0, draw=True):
-        x_list = []
-        y_list = []
+        """
+        :return: (21, 3) array of [id, x, y] in pixels (empty list when there is no such hand) and bbox
+        """
+        height, width, _ = img.shape
+        self.process_landmarks(width, height)
+        self.hand_num = hand_num
         bbox = []
         self.landmark_positions = []
-        if self.results.multi_hand_landmarks:
-            my_hand = self.results.multi_hand_landmarks[hand_num]
-
-            for id, landmark in enumerate(my_hand.landmark):
-                height, width, channels = img.shape
-                cx, cy = int(landmark.x * width), int(landmark.y * height)
-                x_list.append(cx)
-                y_list.append(cy)
-                self.landmark_positions.append([id, cx, cy])
-
-            x_min, x_max = min(x_list), max(x_list)
-            y_min, y_max = min(y_list), max(y_list)
-            bbox = x_min, y_min, x_max, y_max
+        if hand_num < len(self.pixels):
+            self.landmark_positions = np.column_stack((np.arange(LANDMARKS), self.pixels[hand_num]))
+            bbox = x_min, y_min, x_max, y_max = self.bboxes[hand_num].tolist()
 
             if draw:
                 # hand
-                cv2.rectangle(img, (bbox[0]-20, bbox[1]-20), (bbox[2]+20, bbox[3]+20), (0, 255, 0), 2)
-                cv2.circle(img, ((x_max-x_min)//2+x_min, (y_max-y_min)//2+y_min), 30, (255, 0, 0), cv2.FILLED)
+                cv2.rectangle(img, (x_min-20, y_min-20), (x_max+20, y_max+20), (0, 255, 0), 2)
+                cv2.circle(img, tuple(self.centers[hand_num].tolist()), 30, (255, 0, 0), cv2.FILLED)
 
         return self.landmark_positions, bbox
 
     def fingers_up(self):
-        fingers = []
-
-        # thumb
-        if self.landmark_positions[self.tip_ids[0]][1] < self.landmark_positions[self.tip_ids[0] - 1][1]:
-            fingers.append(1)
-        else:
-            fingers.append(0)
-
-        # other fingers
-        for id in range(1, len(self.tip_ids)):
-            if self.landmark_positions[self.tip_ids[id]][2] < self.landmark_positions[self.tip_ids[id] - 2][2]:
-                fingers.append(1)
-            else:
-                fingers.append(0)
-
-        return fingers
-
-    @staticmethod
-    def draw_grid(img, img_height, img_width):
-
-        # Vertical lines
-        cv2.line(img, (img_width//3, 0), (img_width//3, img_height), (0, 0, 255), 1)
-        cv2.line(img, ((img_width//3)*2, 0), ((img_width//3)*2, img_height), (0, 0, 255), 1)
-
-        # Horizontal lines
-        cv2.line(img, (0, img_height//3), (img_width, img_height//3), (0, 0, 255), 1)
-        cv2.line(img, (0, (img_height//3)*2), (img_width, (img_height//3)*2), (0, 0, 255), 1)
-
+        """
+        :return: list of 5 ints, 1 - finger of the hand chosen in find_position_and_bbox is up
+        """
+        return self.fingers[self.hand_num].tolist()
+
+    def draw_hands(self, img, landmarks):
+        """
+        Draws landmarks, bbox and center of the hands. Unlike drawing in find_hands it works on landmarks kept with
+        the frame, so the overlay can be drawn later, on another thread or not at all.
+
+        :param img: BGR frame
+        :param landmarks: (hands, 21, 3) array from find_hands
+        :return: img
+        """
+        height, width, _ = img.shape
+        for hand in (landmarks[:, :, :2] * np.array((width, height), dtype=np.float32)).astype(np.int32).tolist():
+            for start, end in self.mp_hands.HAND_CONNECTIONS:
+                cv2.line(img, hand[start], hand[end], (224, 224, 224), 2)
+            for point in hand:
+                cv2.circle(img, point, 4, (0, 0, 255), cv2.FILLED)
+
+            x_min, y_min = min(x for x, _ in hand), min(y for _, y in hand)
+            x_max, y_max = max(x for x, _ in hand), max(y for _, y in hand)
+            cv2.rectangle(img, (x_min-20, y_min-20), (x_max+20, y_max+20), (0, 255, 0), 2)
+            cv2.circle(img, ((x_max-x_min)//2+x_min, (y_max-y_min)//2+y_min), 30, (255, 0, 0), cv2.FILLED)
         return img
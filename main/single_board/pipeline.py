@@ -0,0 +1,172 @@
+import queue
+import threading
+import time
+
+STOP = object()     # returned by a stage function to stop the whole pipeline
+PUT_TIMEOUT = 0.1   # seconds, how often a blocked stage checks whether the pipeline is stopping
+
+
+class StageStats:
+    """
+    Work done by one stage: how many items it processed and how long its function took.
+    """
+    def __init__(self):
+        self.items = 0
+        self.busy_ns = 0
+        self.max_ns = 0
+        self.dropped = 0    # items thrown away because the stage was too slow to take them
+
+    def add(self, duration_ns):
+        self.items += 1
+        self.busy_ns += duration_ns
+        if duration_ns > self.max_ns:
+            self.max_ns = duration_ns
+
+    def to_dict(self, elapsed):
+        return {'items': self.items,
+                'throughput': round(self.items / elapsed, 1) if elapsed else 0,
+                'mean_ms': round(self.busy_ns / self.items / 1e6, 2) if self.items else 0,
+                'max_ms': round(self.max_ns / 1e6, 2),
+                'dropped': self.dropped}
+
+
+class Stage:
+    """
+    One step of the pipeline. function takes the item produced by the previous stage (None for the first stage)
+    and returns the item for the next one, None to skip the item or STOP.
+    """
+    def __init__(self, name, function, queue_size=2, drop_when_full=False):
+        """
+        :param name: string used in statistics
+        :param function: callable(item)
+        :param queue_size: number of items that may wait for this stage
+        :param drop_when_full: replace the oldest waiting item instead of blocking the previous stage
+        """
+        self.name = name
+        self.function = function
+        self.input = queue.Queue(maxsize=queue_size)
+        self.drop_when_full = drop_when_full
+        self.stats = StageStats()
+
+    def process(self, item):
+        start = time.perf_counter_ns()
+        result = self.function(item)
+        self.stats.add(time.perf_counter_ns() - start)
+        return result
+
+
+class Pipeline:
+    """
+    Runs stages one after another for every item. Threaded, every stage except the last one gets its own thread
+    and the stages are joined by bounded queues, so throughput is limited by the slowest stage instead of the sum
+    of all of them. The last stage runs on the calling thread, which is where OpenCV windows have to live.
+    """
+    def __init__(self, stages):
+        self.stages = stages
+        self.stopping = threading.Event()
+        self.started = 0
+        self.finished = 0
+
+    def run(self, threaded=True):
+        self.started = time.perf_counter()
+        try:
+            if threaded:
+                self.run_threaded()
+            else:
+                self.run_serial()
+        finally:
+            self.finished = time.perf_counter()
+
+    def stop(self):
+        """
+        Makes the pipeline stop after the current items. Safe to call from a signal handler.
+
+        :return: none
+        """
+        self.stopping.set()
+
+    def run_serial(self):
+        while not self.stopping.is_set():
+            item = None
+            for stage in self.stages:
+                item = stage.process(item)
+                if item is STOP:
+                    return
+                if item is None:
+                    break
+
+    def run_threaded(self):
+        threads = [threading.Thread(target=self.run_stage, args=(index,), name=stage.name, daemon=True)
+                   for index, stage in enumerate(self.stages[:-1])]
+        for thread in threads:
+            thread.start()
+        try:
+            self.run_stage(len(self.stages) - 1)
+        finally:
+            self.stopping.set()
+            for thread in threads:
+                thread.join(timeout=1)
+
+    def run_stage(self, index):
+        """
+        Processes items of one stage until STOP comes from the previous stage or the pipeline is stopping.
+        STOP produced here is passed on, so the stages after this one finish the items already queued.
+        """
+        stage = self.stages[index]
+        next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+        try:
+            while not self.stopping.is_set():
+                if index == 0:
+                    item = None
+                else:
+                    try:
+                        item = stage.input.get(timeout=PUT_TIMEOUT)
+                    except queue.Empty:
+                        continue
+                    if item is STOP:
+                        if next_stage is not None:
+                            self.pass_on(next_stage, STOP)
+                        break
+
+                item = stage.process(item)
+                if item is None:
+                    continue
+                if next_stage is None:
+                    if item is STOP:
+                        break
+                    continue
+                self.pass_on(next_stage, item)
+                if item is STOP:
+                    break
+        except BaseException:
+            self.stopping.set()
+            raise
+
+    def pass_on(self, stage, item):
+        if stage.drop_when_full and item is not STOP:
+            while True:
+                try:
+                    stage.input.put_nowait(item)
+                    return
+                except queue.Full:
+                    try:
+                        stage.input.get_nowait()
+                        stage.stats.dropped += 1
+                    except queue.Empty:
+                        pass
+
+        while not self.stopping.is_set():
+            try:
+                stage.input.put(item, timeout=PUT_TIMEOUT)
+                return
+            except queue.Full:
+                pass
+
+    def stats(self):
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        return {stage.name: stage.stats.to_dict(elapsed) for stage in self.stages}
+
+    def print_stats(self):
+        for name, stats in self.stats().items():
+            print(f"{name}: {stats['throughput']} items/s, {stats['mean_ms']} ms mean, {stats['max_ms']} ms max, "
+                  f"{stats['dropped']} dropped")
@@ -0,0 +1,40 @@
+"""
+Plots histograms of the statistics exported by the sender (STATS_FILE in JSON format).
+
+Example:
+    python plot_stats.py sender_stats.json
+"""
+import argparse
+import json
+import matplotlib.pyplot as plt
+from stats import GROWTH
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('file')
+    parser.add_argument('--metrics', nargs='*', help='metrics to plot, all by default')
+    args = parser.parse_args()
+
+    with open(args.file) as file:
+        metrics = json.load(file)['metrics']
+    names = args.metrics or list(metrics)
+
+    figure, axes = plt.subplots(len(names), 1, squeeze=False, figsize=(8, 3 * len(names)))
+    for axis, name in zip(axes[:, 0], names):
+        stats = metrics[name]
+        bounds = [float(bound) for bound in stats['buckets']]
+        counts = list(stats['buckets'].values())
+        widths = [bound * (GROWTH - 1) for bound in bounds]
+        axis.bar(bounds, counts, width=widths, align='edge')
+        for key, style in (('p50', '--'), ('p99', ':')):
+            axis.axvline(stats[key], color='red', linestyle=style, label=f'{key} {stats[key]}')
+        axis.set_xlabel(name)
+        axis.set_ylabel('Frames')
+        axis.legend()
+    figure.tight_layout()
+    plt.show()
+
+
+if __name__ == '__main__':
+    main()
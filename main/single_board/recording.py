@@ -0,0 +1,169 @@
+import mmap
+import struct
+import time
+import cv2
+import numpy as np
+from protocol import MOVES, ACTIONS, MOVE_CODES, ACTION_CODES
+
+# File layout: FILE_HEADER, then for every frame RECORD, landmarks (hands * 21 * 3 float32) and JPEG image
+MAGIC = b'GCRC'
+FILE_VERSION = 1
+FILE_HEADER = struct.Struct('<4sHHH')    # magic, version, frame width, frame height
+RECORD = struct.Struct('<qIBBB')    # capture time in ns from the first frame, JPEG length, hands, move, action
+LANDMARK_SHAPE = (21, 3)
+LANDMARK_DTYPE = np.dtype('<f4')
+LANDMARK_TOLERANCE = 0.02   # largest x or y difference of a replayed landmark still counted as the same, in frame size
+
+
+class Recorder:
+    """
+    Appends frames, detected landmarks and the commands interpreted from them to a recording file. Frames are stored
+    as JPEG, so a minute of 640x480 video takes a few MB.
+    """
+    def __init__(self, path, jpeg_quality=95):
+        self.path = path
+        self.jpeg_quality = jpeg_quality
+        self.file = None
+        self.first_time = None
+        self.frames = 0
+
+    def write(self, img, captured_at, landmarks, movement, action):
+        """
+        :param img: BGR frame as captured, without overlay
+        :param captured_at: time.perf_counter_ns() of the capture
+        :param landmarks: (hands, 21, 3) array from HandDetector
+        :param movement: interpreted move
+        :param action: interpreted action
+        :return: none
+        """
+        if self.file is None:
+            height, width, _ = img.shape
+            self.file = open(self.path, 'wb')
+            self.file.write(FILE_HEADER.pack(MAGIC, FILE_VERSION, width, height))
+            self.first_time = captured_at
+
+        success, jpeg = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+        if not success:
+            return
+        landmarks = np.ascontiguousarray(landmarks, dtype=LANDMARK_DTYPE)
+        self.file.write(RECORD.pack(captured_at - self.first_time, len(jpeg), len(landmarks),
+                                    MOVE_CODES[movement], ACTION_CODES[action]))
+        self.file.write(landmarks.tobytes())
+        self.file.write(jpeg.tobytes())
+        self.frames += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class Replay:
+    """
+    Plays a recording back through the same interface as cv2.VideoCapture. The file is memory-mapped, so frames are
+    decoded straight from the page cache. With realtime set, frames come at the pace they were recorded at,
+    otherwise as fast as they are read.
+    """
+    def __init__(self, path, realtime=False):
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.width, self.height = FILE_HEADER.unpack_from(self.data)
+        if magic != MAGIC or version != FILE_VERSION:
+            raise ValueError(f'{path} is not a recording of version {FILE_VERSION}')
+        self.realtime = realtime
+        self.records = []   # (offset of the record, capture time, hands, move, action) of every frame
+        offset = FILE_HEADER.size
+        while offset + RECORD.size <= len(self.data):
+            time_ns, jpeg_length, hands, move, action = RECORD.unpack_from(self.data, offset)
+            end = offset + RECORD.size + hands * LANDMARK_SHAPE[0] * LANDMARK_SHAPE[1] * 4 + jpeg_length
+            if end > len(self.data):
+                break   # Recording was cut off in the middle of a frame
+            self.records.append((offset, time_ns, hands, MOVES[move], ACTIONS[action]))
+            offset = end
+        self.position = -1  # index of the frame returned by the last read()
+        self.start_time = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def read(self):
+        if self.position + 1 >= len(self.records):
+            return False, None
+        self.position += 1
+        offset, time_ns, hands, _, _ = self.records[self.position]
+
+        if self.realtime:
+            if self.start_time is None:
+                self.start_time = time.perf_counter_ns()
+            delay = self.start_time + time_ns - time.perf_counter_ns()
+            if delay > 0:
+                time.sleep(delay / 1e9)
+
+        _, jpeg_length, _, _, _ = RECORD.unpack_from(self.data, offset)
+        jpeg_offset = offset + RECORD.size + hands * LANDMARK_SHAPE[0] * LANDMARK_SHAPE[1] * 4
+        jpeg = np.frombuffer(self.data, dtype=np.uint8, count=jpeg_length, offset=jpeg_offset)
+        return True, cv2.imdecode(jpeg, cv2.IMREAD_COLOR)
+
+    def landmarks(self, position):
+        """
+        :return: (hands, 21, 3) landmarks recorded for the frame
+        """
+        offset, _, hands, _, _ = self.records[position]
+        count = hands * LANDMARK_SHAPE[0] * LANDMARK_SHAPE[1]
+        return np.frombuffer(self.data, dtype=LANDMARK_DTYPE, count=count,
+                             offset=offset + RECORD.size).reshape(hands, *LANDMARK_SHAPE)
+
+    def command(self, position):
+        """
+        :return: move, action recorded for the frame
+        """
+        _, _, _, move, action = self.records[position]
+        return move, action
+
+    def release(self):
+        self.data.close()
+        self.file.close()
+
+
+class ReplayReport:
+    """
+    Compares landmarks and commands of the replay with the recorded ones and collects per-frame latency.
+    Frames are stored as JPEG and the recording may have tracked landmarks instead of running the model, so
+    landmarks are compared with a tolerance. Commands are compared exactly; they also depend on the frames
+    voting before them, so a single landmark difference can change a few of them.
+    """
+    def __init__(self, replay, tolerance=LANDMARK_TOLERANCE):
+        self.replay = replay
+        self.tolerance = tolerance
+        self.frames = 0
+        self.landmark_mismatches = 0
+        self.mismatches = 0
+        self.latencies_ms = []
+
+    def check(self, position, landmarks, movement, action, captured_at):
+        """
+        :param position: number of the replayed frame
+        :param landmarks: (hands, 21, 3) landmarks found in the replay
+        :param movement: interpreted move
+        :param action: interpreted action
+        :param captured_at: time.perf_counter_ns() when the frame was read
+        :return: none
+        """
+        self.frames += 1
+        recorded = self.replay.landmarks(position)
+        if len(recorded) != len(landmarks) or \
+                (len(recorded) and np.abs(recorded[:, :, :2] - landmarks[:, :, :2]).max() > self.tolerance):
+            self.landmark_mismatches += 1
+        if (movement, action) != self.replay.command(position):
+            self.mismatches += 1
+        self.latencies_ms.append((time.perf_counter_ns() - captured_at) / 1e6)
+
+    def print(self):
+        print(f'Replayed frames: {self.frames} of {len(self.replay)}, '
+              f'landmarks further than {self.tolerance} from the recording: {self.landmark_mismatches}, '
+              f'commands different from the recording: {self.mismatches}')
+        if self.latencies_ms:
+            latencies = sorted(self.latencies_ms)
+            p50 = latencies[len(latencies) // 2]
+            p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            print(f'Frame latency from capture to send: mean {round(sum(latencies) / len(latencies), 2)} ms, '
+                  f'p50 {round(p50, 2)} ms, p99 {round(p99, 2)} ms, max {round(latencies[-1], 2)} ms')
@@ -1,133 +1,252 @@
-import cv2
 import time
+STARTED = time.perf_counter()   # before the imports, so their time counts into the startup
+import cv2
+import signal
+from concurrent.futures import ThreadPoolExecutor
 from hand_tracking_module import HandDetector
-from client import connect_to_server, send_object_message
-from dataclasses import dataclass
-import collections
-import matplotlib.pyplot as plt
+from capture import FrameGrabber
+from pipeline import Pipeline, Stage, STOP
+from gestures import GestureEngine
+from zones import ZoneIndex, LAYOUTS
+from recording import Recorder, Replay, ReplayReport
+from tracking import AdaptiveInference
+from camera import open_camera
+from client import connect_to_server, handshake_name, send_message, open_datagram_socket, send_datagram, CommandSender, \
+    IP, PORT
+from clock_sync import ClockSync
+from dataclasses import dataclass, field
+from functools import partial
+from stats import StatsCollector
+from tracing import TraceWriter
 
 # SETTINGS
 SEND_TIME_INFO = True
 COLLECT_FPS_STAT = True
 MEASURE_TIME = True
+STATS_FILE = 'sender_stats.json'    # .json or .csv, plot it with plot_stats.py
+STATS_INTERVAL = 5  # seconds between exports of the statistics
+TRACE_FILE = None   # path - log capture, inference and send time of every command, merge it with trace_merge.py
+CLOCK_SYNC = True   # estimate the relay's clock and stamp commands and traces with it, so lag across hosts is right
+TRANSPORT = 'tcp'   # 'tcp' - reliable stream through the server, 'udp' - latest-wins datagrams
+SEND_ONLY_CHANGES = True
+HEARTBEAT_INTERVAL = 0.5    # seconds without sending after which the current movement is repeated
+SESSION = ''    # game session to control, must match SESSION of the game
+THREADED_CAPTURE = True    # read the camera on a separate thread and process only the newest frame
+PIPELINED = True   # run capture, inference, sending and display concurrently, each stage on its own thread
+PIPELINE_QUEUE_SIZE = 2     # frames that may wait between two stages after the inference
+ROI_TRACKING = True    # after finding a hand, run inference on a crop around it instead of the whole frame
+GESTURE_WINDOW = 3  # frames voting on the raised fingers
+GESTURE_VOTES = 2   # votes needed to accept a change of the raised fingers
+ZONE_LAYOUT = 'grid3x3'     # movement zones, one of zones.LAYOUTS
+RECORD_FILE = None  # path - record frames, landmarks and commands for a later replay
+REPLAY_FILE = None  # path - process a recording instead of the camera and compare the commands
+REPLAY_REALTIME = False     # replay at the recorded pace instead of as fast as possible
+REPLAY_SEND = False     # send replayed commands to the relay too, otherwise no relay is needed for a replay
+REPLAY_DISPLAY_MODE = 'headless'    # DISPLAY_MODE used during a replay
+DISPLAY_MODE = 'full'   # 'full', 'reduced' - window updated every OVERLAY_INTERVAL frames, 'headless' - no window
+OVERLAY_INTERVAL = 5
+ADAPTIVE_INFERENCE = True  # run the model only every few frames and track the landmarks with optical flow between
+TARGET_FRAME_MS = 20    # average inference time per frame the adaptive interval aims for
+MAX_INFERENCE_INTERVAL = 5  # frames
+CAMERA_INDEX = 0
+CAMERA_WIDTH = 640  # lowest resolution accepted when choosing the camera mode
+CAMERA_HEIGHT = 480
+CAMERA_PROFILE_FILE = 'camera_profile.json'    # mode chosen by probing, delete it to probe again
 
 
 @dataclass
-class MovementField:
-    x: float
-    y: float
-    width: float
-    height: float
-    movement: str
-
-    def point_in_rect(self, point):
-        p_x, p_y = point
-        if self.x < p_x < self.x + self.width:
-            if self.y < p_y < self.y + self.height:
-                return True
-        return False
-
+class Frame:
+    img: object
+    captured_at: int = 0    # time.perf_counter_ns()
+    inferred_at: int = 0
+    number: int = -1    # position in the replayed recording
+    raw: object = None  # image as captured, kept only for the recorder
+    landmarks: object = None
+    landmark_positions: list = field(default_factory=list)
+    bbox: tuple = ()
+    fingers: list = field(default_factory=list)
+    movement: str = ''
+    action: str = ''
 
-def interpret_hand_movement(bbox, img_width, img_height):
-    movement_fields = generate_movement_fields(img_width, img_height)
 
+def interpret_hand_movement(bbox, img_width, img_height, zones):
     # Movement
     x_min, y_min, x_max, y_max = bbox
     hand_center = (x_max - x_min) // 2 + x_min, (y_max - y_min) // 2 + y_min
+    return zones.movement(hand_center, img_width, img_height)
 
-    interpreted_movement = ''
-    for mf in movement_fields:
-        if mf.point_in_rect(hand_center):
-            interpreted_movement = mf.movement
-            break
 
-    return interpreted_movement
+def open_frame_source():
+    if REPLAY_FILE:
+        return Replay(REPLAY_FILE, REPLAY_REALTIME)
+    cap = open_camera(CAMERA_INDEX, CAMERA_WIDTH, CAMERA_HEIGHT, CAMERA_PROFILE_FILE)
+    if THREADED_CAPTURE:
+        cap = FrameGrabber(cap).start()
+    return cap
 
 
-def generate_movement_fields(img_width, img_height):
-    return [MovementField(0, 0, img_width / 3, img_height / 3, 'up-left'),
-            MovementField(img_width / 3, 0, img_width / 3, img_height / 3, 'up'),
-            MovementField((img_width / 3) * 2, 0, img_width / 3, img_height / 3, 'up-right'),
-            MovementField(0, img_height / 3, img_width / 3, img_height / 3, 'left'),
-            MovementField(img_width / 3, img_height / 3, img_width / 3, img_height / 3, 'stand'),
-            MovementField((img_width / 3) * 2, img_height / 3, img_width / 3, img_height / 3, 'right'),
-            MovementField(0, (img_height / 3) * 2, img_width / 3, img_height / 3, 'down-left'),
-            MovementField(img_width / 3, (img_height / 3) * 2, img_width / 3, img_height / 3, 'down'),
-            MovementField((img_width / 3) * 2, (img_height / 3) * 2, img_width / 3, img_height / 3, 'down-right')]
+def discard(message):
+    pass
 
 
-def main():
-    if COLLECT_FPS_STAT:
-        fps_val = collections.deque(maxlen=10000)
+def open_command_channel():
+    if REPLAY_FILE and not REPLAY_SEND:
+        return discard
+    if TRANSPORT == 'udp':
+        return partial(send_datagram, open_datagram_socket(), handshake_name('RoboPies', session=SESSION))
+    return partial(send_message, connect_to_server('RoboPies', session=SESSION))
+
+
+def timed(phases, name, function, *args, **kwargs):
+    """
+    Calls the function and stores how long it took in phases[name], in ms.
+    """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    phases[name] = round((time.perf_counter() - start) * 1000, 1)
+    return result
 
-    if MEASURE_TIME:
-        time_val = collections.deque(maxlen=10000)
+
+def main():
+    stats = StatsCollector(STATS_FILE if COLLECT_FPS_STAT or MEASURE_TIME else None, STATS_INTERVAL)
 
     prev_time = 0
     curr_time = 0
-    cap = cv2.VideoCapture(0)
-    detector = HandDetector(max_hands=1, detection_con=0.7)
+    displayed = 0
+
+    clock = ClockSync('RoboPies', (IP, PORT)).start() if CLOCK_SYNC else None
+    display_mode = REPLAY_DISPLAY_MODE if REPLAY_FILE else DISPLAY_MODE
+
+    # Startup phases - the camera, the server and the model do not depend on each other, so they start together
+    phases = {'imports': round((time.perf_counter() - STARTED) * 1000, 1)}
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        cap_future = pool.submit(timed, phases, 'camera', open_frame_source)
+        send_future = pool.submit(timed, phases, 'connect', open_command_channel)
+        detector_future = pool.submit(timed, phases, 'model', HandDetector, max_hands=1, detection_con=0.7,
+                                      roi_tracking=ROI_TRACKING)
+        cap, send, detector = cap_future.result(), send_future.result(), detector_future.result()
+    phases['ready'] = round((time.perf_counter() - STARTED) * 1000, 1)
+    print('Startup: ' + ', '.join(f'{phase} {duration} ms' for phase, duration in phases.items()))
+    stats.info['startup_ms'] = phases
+
+    if REPLAY_FILE:
+        replay = cap
+        report = ReplayReport(replay)
+    recorder = Recorder(RECORD_FILE) if RECORD_FILE else None
+    # The adaptive interval depends on timing, a replay runs the model on every frame to be repeatable
+    adaptive = ADAPTIVE_INFERENCE and not REPLAY_FILE
+    hands = AdaptiveInference(detector, TARGET_FRAME_MS, MAX_INFERENCE_INTERVAL) if adaptive else None
+    commands = CommandSender(send, SEND_ONLY_CHANGES, HEARTBEAT_INTERVAL, SEND_TIME_INFO,
+                             clock.now if CLOCK_SYNC else time.time_ns)
+    trace = TraceWriter(TRACE_FILE, 'board', commands.clock) if TRACE_FILE else None
+    wall_offset = time.time_ns() - time.perf_counter_ns()    # turns perf_counter_ns() stamps into time.time_ns()
+
+    gestures = GestureEngine(GESTURE_WINDOW, GESTURE_VOTES)
+    zones = ZoneIndex(LAYOUTS[ZONE_LAYOUT])
 
-    client_socket = connect_to_server('RoboPies')
+    def capture(_):
+        if isinstance(cap, FrameGrabber):
+            success, img, captured_at = cap.read_timed()    # Time spent waiting in the grabber counts
+        else:
+            success, img = cap.read()
+            captured_at = time.perf_counter_ns()
+        if not success:
+            print('Camera stopped delivering frames')
+            return STOP
+        frame = Frame(img, captured_at)
+        if REPLAY_FILE:
+            frame.number = replay.position
+        if recorder is not None:
+            frame.raw = img
+        return frame
 
-    # Actions specific variables
-    player_action = ''
-    was_shot = False
-    was_changed = False
+    def frame_age(stage, frame):
+        if MEASURE_TIME:
+            stats.add(f'frame_age_{stage}_ms', (time.perf_counter_ns() - frame.captured_at) / 1e6)
+
+    def preprocess(frame):
+        frame_age('preprocess', frame)
+        frame.img = cv2.flip(frame.img, 1)
+        return frame
 
-    while True:
-        success, img = cap.read()
-        img_height, img_width, _ = img.shape
-        img = cv2.flip(img, 1)
+    def inference(frame):
+        frame_age('inference', frame)
         if MEASURE_TIME:
             start = time.perf_counter_ns()
-        img = detector.find_hands(img)
-        landmark_positions, bbox = detector.find_position_and_bbox(img, draw=True)
+        if hands is not None:
+            frame.img = hands.find_hands(frame.img)
+        else:
+            frame.img = detector.find_hands(frame.img, draw=False)
+        frame.landmark_positions, frame.bbox = detector.find_position_and_bbox(frame.img, draw=False)
+        frame.landmarks = detector.landmarks
+        frame.inferred_at = time.perf_counter_ns()
+        if len(frame.landmark_positions) != 0:
+            frame.fingers = detector.fingers_up()
         if MEASURE_TIME:
-            stop = round((time.perf_counter_ns() - start)/1_000_000, 2)
-            time_val.append(stop)
-        img = HandDetector.draw_grid(img, img_height, img_width)
-
-        interpreted_movement = ''
-
-        if len(landmark_positions) != 0:
-            # Check mode - clenched fist = interpret gestures, opened hand = ignore gestures
-            fingers = detector.fingers_up()
-            if sum(fingers) != 5:
-                # Interpret gestures
-                # Movement
-                interpreted_movement = interpret_hand_movement(bbox, img_width, img_height)
-
-                # Actions
-                # Pointing finger up - one shot
-                if fingers[1] == 1 and not was_shot:
-                    player_action = 'shoot'
-                    was_shot = True
-
-                # Middle finger up - weapon change
-                elif fingers[2] == 1 and not was_changed:
-                    player_action = 'change'
-                    was_changed = True
-
-                # Reset the action
-                else:
-                    player_action = ''
-                    if fingers[1] != 1:
-                        was_shot = False
-                    if fingers[2] != 1:
-                        was_changed = False
-
-            # Sending orders to the server
-            message_to_send = {'move': interpreted_movement, 'action': player_action}
-            if SEND_TIME_INFO:
-                message_to_send['time'] = time.time_ns()
-            send_object_message(client_socket, message_to_send)
+            stats.add('inference_ms', (time.perf_counter_ns() - start) / 1e6)
+        return frame
+
+    def interpret(frame):
+        if len(frame.landmark_positions) == 0:
+            gestures.reset()
+            return frame
+
+        # Clenched fist = interpret gestures, opened hand = ignore gestures
+        active, frame.action = gestures.update(frame.fingers)
+        if active:
+            img_height, img_width, _ = frame.img.shape
+            frame.movement = interpret_hand_movement(frame.bbox, img_width, img_height, zones)
+        return frame
 
+    def send_commands(frame):
+        if MEASURE_TIME:
+            start = time.perf_counter_ns()
+        # Sending orders to the server
+        last_seq = commands.seq
+        if len(frame.landmark_positions) != 0:
+            commands.update(frame.movement, frame.action)
+        else:
+            commands.hand_lost()
+        commands.heartbeat()
+        if trace is not None:
+            for seq in range(last_seq + 1, commands.seq + 1):
+                captured_at, inferred_at = frame.captured_at + wall_offset, frame.inferred_at + wall_offset
+                if CLOCK_SYNC:
+                    captured_at, inferred_at = clock.to_relay_time(captured_at), clock.to_relay_time(inferred_at)
+                trace.stamp('capture', seq, captured_at)
+                trace.stamp('inference', seq, inferred_at)
+                trace.stamp('send', seq, commands.sent_at)
+        if 'first_command' not in phases and commands.sent:
+            phases['first_command'] = round((time.perf_counter() - STARTED) * 1000, 1)
+            print(f"Time to first command: {phases['first_command']} ms")
+        if MEASURE_TIME:
+            now = time.perf_counter_ns()
+            stats.add('send_ms', (now - start) / 1e6)
+            stats.add('capture_to_send_ms', (now - frame.captured_at) / 1e6)
+
+        if recorder is not None:
+            recorder.write(frame.raw, frame.captured_at, frame.landmarks, frame.movement, frame.action)
+        if REPLAY_FILE:
+            report.check(frame.number, frame.landmarks, frame.movement, frame.action, frame.captured_at)
+        return frame
+
+    def display(frame):
+        nonlocal prev_time, curr_time, displayed
         curr_time = time.time()
         fps = 1 / (curr_time - prev_time)
-        if COLLECT_FPS_STAT:
-            fps_val.append(fps)
+        if COLLECT_FPS_STAT and prev_time:
+            stats.add('fps', fps)
         prev_time = curr_time
+        stats.maybe_export()
+
+        if display_mode == 'headless':
+            return frame
+        displayed += 1
+        if display_mode == 'reduced' and displayed % OVERLAY_INTERVAL:
+            return frame
+
+        img = detector.draw_hands(frame.img, frame.landmarks)
+        img = zones.draw_grid(img)
         cv2.putText(img, str(int(fps)), (10, 70), cv2.FONT_HERSHEY_PLAIN, 3, (255, 0, 255), thickness=3)
 
         cv2.imshow('Frame', img)
@@ -135,26 +254,49 @@ def main():
         if cv2.waitKey(1) & 0xFF == ord("q") or cv2.getWindowProperty(
             "Frame", cv2.WND_PROP_VISIBLE
         ) < 1:
-            if COLLECT_FPS_STAT:
-                print(f'Average FPS: {round(sum(fps_val)/len(fps_val), 2)}')
-                plt.plot(fps_val)
-                plt.ylabel('FPS')
-                plt.show()
-                plt.hist(fps_val)
-                plt.xlabel('FPS')
-                plt.show()
-            if MEASURE_TIME:
-                print(f'Average time the neural network takes to process 1 frame: {round(sum(time_val)/len(time_val), 2)}')
-                plt.plot(time_val)
-                plt.ylabel('Time in ms')
-                plt.show()
-                plt.hist(time_val)
-                plt.xlabel('Time in ms')
-                plt.show()
-            break
+            return STOP
+        return frame
+
+    # Up to the inference only the newest frame may wait - a queue of old frames would undo the FrameGrabber.
+    # A replay has to process every recorded frame, so there the stages wait for each other instead.
+    latest_only = not REPLAY_FILE
+    pipeline = Pipeline([Stage('capture', capture),
+                         Stage('preprocess', preprocess, 1, drop_when_full=latest_only),
+                         Stage('inference', inference, 1, drop_when_full=latest_only),
+                         Stage('interpretation', interpret, PIPELINE_QUEUE_SIZE),
+                         Stage('send', send_commands, PIPELINE_QUEUE_SIZE),
+                         Stage('display', display, PIPELINE_QUEUE_SIZE, drop_when_full=True)])
+    for signal_number in (signal.SIGINT, signal.SIGTERM):    # The only way to stop without a window
+        signal.signal(signal_number, lambda *_: pipeline.stop())
+    pipeline.run(threaded=PIPELINED)
+
+    print(f'Commands sent: {commands.sent}, unchanged and not sent: {commands.suppressed}')
+    if CLOCK_SYNC:
+        clock.stop()
+        print(f'Clock of the relay: {clock.stats()}')
+        stats.info['clock_sync'] = clock.stats()
+    if isinstance(cap, FrameGrabber):
+        print(f'Frames captured: {cap.captured}, dropped as stale: {cap.dropped}')
+    if trace is not None:
+        trace.close()
+    if recorder is not None:
+        recorder.close()
+        print(f'Frames recorded to {RECORD_FILE}: {recorder.frames}')
+    if REPLAY_FILE:
+        report.print()
+    pipeline.print_stats()
+    if hands is not None:
+        print(f'Frames processed by the model: {hands.detections}, tracked with optical flow: {hands.tracked}, '
+              f'last interval: {hands.interval}')
+    if ROI_TRACKING:
+        print(f'Frames processed as a crop: {detector.roi_frames}, as a whole: {detector.full_frames}')
+    if COLLECT_FPS_STAT or MEASURE_TIME:
+        stats.export()
+        stats.print()
 
     cap.release()
-    cv2.destroyAllWindows()
+    if display_mode != 'headless':
+        cv2.destroyAllWindows()
 
 
 if __name__ == '__main__':
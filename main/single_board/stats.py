@@ -0,0 +1,118 @@
+import csv
+import json
+import math
+import os
+import threading
+import time
+
+GROWTH = 1.05   # width of a histogram bucket relative to its lower bound - percentiles are within 5%
+
+
+class StreamingStats:
+    """
+    Summary of a stream of positive values in constant memory: count, mean, extremes and a histogram with
+    logarithmic buckets, from which percentiles are read.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = math.inf
+        self.max = 0
+        self.buckets = {}   # bucket number -> count, bucket i holds values in [GROWTH**i, GROWTH**(i+1))
+
+    def add(self, value):
+        if value <= 0:
+            return
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        bucket = math.floor(math.log(value, GROWTH))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, p):
+        """
+        :param p: 0 - 100
+        :return: upper bound of the bucket holding given percentile, clipped to the extremes
+        """
+        if not self.count:
+            return 0
+        rank = self.count * p / 100
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(max(GROWTH ** (bucket + 1), self.min), self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count,
+                'mean': round(self.total / self.count, 3) if self.count else 0,
+                'min': round(self.min, 3) if self.count else 0,
+                'p50': round(self.percentile(50), 3),
+                'p90': round(self.percentile(90), 3),
+                'p99': round(self.percentile(99), 3),
+                'max': round(self.max, 3),
+                'buckets': {round(GROWTH ** bucket, 4): count for bucket, count in sorted(self.buckets.items())}}
+
+
+class StatsCollector:
+    """
+    Named StreamingStats shared by the pipeline stages, exported every interval seconds to a JSON or CSV file
+    (chosen by the extension). Plots are made from the file by plot_stats.py, outside the running process.
+    """
+    def __init__(self, path=None, interval=5):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.info = {}  # other values to export as they are, e.g. startup times
+        self.started = time.time()
+        self.next_export = time.monotonic() + interval
+
+    def add(self, name, value):
+        with self.lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = StreamingStats()
+            stats.add(value)
+
+    def snapshot(self):
+        with self.lock:
+            return {'started': self.started,
+                    'uptime_s': round(time.time() - self.started, 1),
+                    **self.info,
+                    'metrics': {name: stats.to_dict() for name, stats in self.stats.items()}}
+
+    def maybe_export(self):
+        if self.path and time.monotonic() >= self.next_export:
+            self.next_export = time.monotonic() + self.interval
+            self.export()
+
+    def export(self):
+        """
+        Replaces the file atomically, so a reader never sees a half written snapshot.
+
+        :return: none
+        """
+        if not self.path:
+            return
+        snapshot = self.snapshot()
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w', newline='') as file:
+            if self.path.endswith('.csv'):
+                writer = csv.writer(file)
+                writer.writerow(['metric', 'count', 'mean', 'min', 'p50', 'p90', 'p99', 'max'])
+                for name, stats in snapshot['metrics'].items():
+                    writer.writerow([name] + [stats[key] for key in ('count', 'mean', 'min', 'p50', 'p90', 'p99',
+                                                                     'max')])
+            else:
+                json.dump(snapshot, file, indent=2)
+        os.replace(temp_path, self.path)
+
+    def print(self):
+        for name, stats in self.snapshot()['metrics'].items():
+            print(f"{name}: mean {stats['mean']}, p50 {stats['p50']}, p99 {stats['p99']}, max {stats['max']} "
+                  f"({stats['count']} samples)")
@@ -0,0 +1,71 @@
+import struct
+import threading
+import time
+
+
+# Trace log format shared by single_board, server and env_simulation - keep the copies identical
+TRACE_VERSION = 1
+TRACE_MAGIC = b'GCTR'
+TRACE_HEADER = struct.Struct('<4sB32s')     # magic, version, process name
+TRACE_RECORD = struct.Struct('<BIq')    # stage, command sequence number, time.time_ns()
+FLUSH_SIZE = 64 * 1024
+
+# Stages of a command, in the order it passes them
+STAGES = ('capture', 'inference', 'send', 'relay_in', 'relay_out', 'game_receive', 'apply')
+STAGE_CODES = {stage: code for code, stage in enumerate(STAGES)}
+
+
+class TraceWriter:
+    """
+    Appends stage timestamps of commands to a binary log. Records are 13 bytes and are buffered in memory,
+    so stamping costs a struct.pack; call close() to write the rest.
+    """
+    def __init__(self, path, process_name, clock=time.time_ns):
+        """
+        :param path: file to write
+        :param process_name: 'board', 'relay' or 'game', trace_merge.py offsets are given by it
+        :param clock: function returning the time of stamps, e.g. ClockSync.now to stamp in the relay's time
+        """
+        self.clock = clock
+        self.file = open(path, 'wb')
+        self.file.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, process_name.encode('utf-8')[:32]))
+        self.buffer = bytearray()
+        self.lock = threading.Lock()    # Stages of the sender and the game stamp from different threads
+
+    def stamp(self, stage, seq, time_ns=None):
+        """
+        :param stage: one of STAGES
+        :param seq: sequence number of the command
+        :param time_ns: time of the event on the writer's clock, now by default
+        :return: none
+        """
+        record = TRACE_RECORD.pack(STAGE_CODES[stage], seq, self.clock() if time_ns is None else time_ns)
+        with self.lock:
+            self.buffer += record
+            if len(self.buffer) >= FLUSH_SIZE:
+                self.flush()
+
+    def flush(self):
+        self.file.write(self.buffer)
+        self.buffer.clear()
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.file.close()
+
+
+def read_trace(path):
+    """
+    :param path: file written by TraceWriter
+    :return: process name, list of (stage, seq, time_ns)
+    """
+    with open(path, 'rb') as file:
+        data = file.read()
+    magic, version, name = TRACE_HEADER.unpack_from(data)
+    if magic != TRACE_MAGIC or version != TRACE_VERSION:
+        raise ValueError(f'{path} is not a trace log of version {TRACE_VERSION}')
+    end = len(data) - (len(data) - TRACE_HEADER.size) % TRACE_RECORD.size    # Skip a record cut off by a crash
+    records = [(STAGES[stage], seq, time_ns)
+               for stage, seq, time_ns in TRACE_RECORD.iter_unpack(data[TRACE_HEADER.size:end])]
+    return name.rstrip(b'\0').decode('utf-8'), records
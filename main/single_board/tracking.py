@@ -0,0 +1,113 @@
+import math
+import time
+import cv2
+import numpy as np
+
+LK_PARAMS = dict(winSize=(21, 21), maxLevel=3,
+                 criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03))
+
+
+class LandmarkTracker:
+    """
+    Follows landmarks found by the model from frame to frame with sparse Lucas-Kanade optical flow.
+    """
+    def __init__(self, min_tracked=0.8):
+        """
+        :param min_tracked: fraction of landmarks that have to be found again, otherwise the hands are lost
+        """
+        self.min_tracked = min_tracked
+        self.prev_gray = None
+        self.landmarks = None   # (hands, 21, 3) normalized
+
+    def reset(self, gray, landmarks):
+        self.prev_gray = gray
+        self.landmarks = landmarks if len(landmarks) else None
+
+    def track(self, gray):
+        """
+        :param gray: grayscale frame
+        :return: (hands, 21, 3) landmarks moved to the new frame or None when they could not be followed
+        """
+        if self.landmarks is None or self.prev_gray is None or self.prev_gray.shape != gray.shape:
+            return None
+        height, width = gray.shape
+        scale = np.array((width, height), dtype=np.float32)
+        points = (self.landmarks[:, :, :2] * scale).reshape(-1, 1, 2)
+        new_points, status, _ = cv2.calcOpticalFlowPyrLK(self.prev_gray, gray, points, None, **LK_PARAMS)
+        if new_points is None or status.mean() < self.min_tracked:
+            return None
+
+        found = status.reshape(-1).astype(bool)
+        moved = points.reshape(-1, 2).copy()
+        moved[found] = new_points.reshape(-1, 2)[found]     # Landmarks that were not found stay where they were
+        landmarks = self.landmarks.copy()
+        landmarks[:, :, :2] = moved.reshape(landmarks.shape[0], -1, 2) / scale
+        self.prev_gray = gray
+        self.landmarks = landmarks
+        return landmarks
+
+
+class AdaptiveInference:
+    """
+    Runs the hand model only every interval frames and tracks the landmarks with optical flow in between.
+    The interval follows the measured cost of both, so that the average frame stays within target_ms.
+    """
+    def __init__(self, detector, target_ms=20, max_interval=5, smoothing=0.1):
+        """
+        :param detector: HandDetector
+        :param target_ms: average processing time of a frame to aim for
+        :param max_interval: the model runs at least every max_interval frames
+        :param smoothing: weight of the newest measurement in the moving averages
+        """
+        self.detector = detector
+        self.tracker = LandmarkTracker()
+        self.target_ms = target_ms
+        self.max_interval = max_interval
+        self.smoothing = smoothing
+        self.detect_ms = 0
+        self.track_ms = 0
+        self.interval = 1
+        self.since_detection = 0
+        self.detections = 0
+        self.tracked = 0
+
+    def find_hands(self, img):
+        """
+        Leaves landmarks of the frame in the detector, like HandDetector.find_hands(img, draw=False).
+
+        :param img: BGR frame
+        :return: img
+        """
+        start = time.perf_counter_ns()
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        if self.since_detection + 1 < self.interval:
+            landmarks = self.tracker.track(gray)
+            if landmarks is not None:
+                self.detector.set_landmarks(landmarks)
+                self.since_detection += 1
+                self.tracked += 1
+                self.track_ms = self.average(self.track_ms, (time.perf_counter_ns() - start) / 1e6)
+                return img
+
+        self.detector.find_hands(img, draw=False)
+        self.tracker.reset(gray, self.detector.landmarks)
+        self.since_detection = 0
+        self.detections += 1
+        self.detect_ms = self.average(self.detect_ms, (time.perf_counter_ns() - start) / 1e6)
+        self.adapt()
+        return img
+
+    def average(self, average, value):
+        return value if not average else average + self.smoothing * (value - average)
+
+    def adapt(self):
+        """
+        Chooses the smallest interval for which (detect_ms + (interval - 1) * track_ms) / interval <= target_ms.
+        """
+        if self.detect_ms <= self.target_ms:
+            self.interval = 1
+        elif self.track_ms >= self.target_ms:
+            self.interval = self.max_interval
+        else:
+            needed = math.ceil((self.detect_ms - self.track_ms) / (self.target_ms - self.track_ms))
+            self.interval = max(1, min(self.max_interval, needed))
@@ -0,0 +1,96 @@
+from dataclasses import dataclass
+import cv2
+
+
+@dataclass(frozen=True)
+class ZoneLayout:
+    columns: tuple  # relative widths of the columns, left to right
+    rows: tuple     # relative heights of the rows, top to bottom
+    moves: tuple    # move of every zone, one tuple per row
+
+    def edges(self, weights, length):
+        """
+        :return: list of integer zone boundaries from 0 to length, a pixel lying on a boundary belongs to the zone
+                 before it and x or y = 0 to the first zone - the grid this replaced left both without a move ('')
+        """
+        total = sum(weights)
+        edges = [0]
+        accumulated = 0
+        for weight in weights[:-1]:
+            accumulated += weight
+            edges.append(int(length * accumulated / total) + 1)
+        edges.append(length)
+        return edges
+
+
+DIRECTIONS = (('up-left', 'up', 'up-right'),
+              ('left', 'stand', 'right'),
+              ('down-left', 'down', 'down-right'))
+
+
+def dead_zone_layout(size):
+    """
+    3x3 layout with a central 'stand' zone of given size.
+
+    :param size: width and height of the central zone as a fraction of the frame, e.g. 0.5
+    :return: ZoneLayout
+    """
+    side = (1 - size) / 2
+    return ZoneLayout((side, size, side), (side, size, side), DIRECTIONS)
+
+
+LAYOUTS = {'grid3x3': ZoneLayout((1, 1, 1), (1, 1, 1), DIRECTIONS),
+           'dead_zone': dead_zone_layout(0.5),
+           'grid5x5': ZoneLayout((1, 1, 1, 1, 1), (1, 1, 1, 1, 1),
+                                 (('up-left', 'up', 'up', 'up', 'up-right'),
+                                  ('left', 'stand', 'stand', 'stand', 'right'),
+                                  ('left', 'stand', 'stand', 'stand', 'right'),
+                                  ('left', 'stand', 'stand', 'stand', 'right'),
+                                  ('down-left', 'down', 'down', 'down', 'down-right')))}
+
+
+class ZoneIndex:
+    """
+    Maps a point of the frame straight to its movement zone. Column of every x and row of every y are precomputed
+    once per resolution, so a lookup is two list indexings instead of testing the zones one by one.
+    """
+    def __init__(self, layout=LAYOUTS['grid3x3']):
+        self.layout = layout
+        self.size = None    # width, height the index was built for
+        self.column_of_x = []
+        self.row_of_y = []
+        self.x_edges = []
+        self.y_edges = []
+
+    def build(self, width, height):
+        self.x_edges = self.layout.edges(self.layout.columns, width)
+        self.y_edges = self.layout.edges(self.layout.rows, height)
+        self.column_of_x = [column for column in range(len(self.layout.columns))
+                            for _ in range(self.x_edges[column], self.x_edges[column + 1])]
+        self.row_of_y = [row for row in range(len(self.layout.rows))
+                         for _ in range(self.y_edges[row], self.y_edges[row + 1])]
+        self.size = width, height
+
+    def movement(self, point, width, height):
+        """
+        :param point: x, y in pixels
+        :param width: frame width
+        :param height: frame height
+        :return: move of the zone holding the point
+        """
+        if self.size != (width, height):
+            self.build(width, height)
+        x = min(max(int(point[0]), 0), width - 1)
+        y = min(max(int(point[1]), 0), height - 1)
+        return self.layout.moves[self.row_of_y[y]][self.column_of_x[x]]
+
+    def draw_grid(self, img):
+        height, width, _ = img.shape
+        if self.size != (width, height):
+            self.build(width, height)
+
+        for x in self.x_edges[1:-1]:
+            cv2.line(img, (x, 0), (x, height), (0, 0, 255), 1)
+        for y in self.y_edges[1:-1]:
+            cv2.line(img, (0, y), (width, y), (0, 0, 255), 1)
+        return img